@@ -0,0 +1,198 @@
+"""
+Micro-benchmarks of the pipeline stages and of each model's build and query paths on a synthetic corpus
+(recommenders.synthetic), which is the same for the same size and seed, so that runs are comparable.
+
+    python -m recommenders.benchmark [--docs N] [--seed S] [--topics T] [--repeat R] [--only name,...] [--out run.json]
+    python -m recommenders.benchmark --compare base.json new.json [--threshold 0.1]
+
+The comparison flags benchmarks whose median time grew by more than the threshold and exits with 1 if any did
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+from statistics import median
+from time import perf_counter, strftime
+
+import numpy as np
+
+MODELS = ['lsi', 'lda', 'd2v', 'artm']
+
+
+class Env:
+    """Everything the benchmarks share: raw and preprocessed texts, the corpus on disk and the built models"""
+    def __init__(self, workdir, n_docs, seed, n_topics, n_queries=100):
+        from recommenders.corpus import Tfidf
+        from recommenders.synthetic import generate, write_corpus
+        from recommenders.util import load_uci
+
+        # a folder per size and seed: ARTM reads the UCI files of the whole folder, and a reused corpus must match
+        self.location = os.path.join(workdir, 'corpus-%d-%d' % (n_docs, seed), 'corpus.uci')
+        self.n_topics = n_topics
+        self.raw = [text for _, _, text in generate(n_docs, seed)]
+        if not os.path.exists(self.location + '.vocab'):
+            write_corpus(self.location, n_docs, seed)
+        self.corpus, self.texts, self.dictionary, _ = load_uci(self.location)
+        self.tfidf = Tfidf(self.dictionary)
+        self.corpus_tfidf = self.tfidf[self.corpus]
+        rng = random.Random(seed)
+        self.query_ids = [rng.randrange(n_docs) for _ in range(n_queries)]
+        self.models = {}
+
+    def queries(self, model):
+        """Query documents in the form `model` takes them"""
+        if model == 'd2v':
+            return [self.texts[i] for i in self.query_ids]
+        corpus = self.corpus if model == 'artm' else self.corpus_tfidf
+        return [corpus[i] for i in self.query_ids]
+
+
+def build(env, model):
+    from recommenders.models import LsiModel, LdaModel, Doc2vecModel, BigArtmModel
+    if model == 'lsi':
+        env.models[model] = LsiModel(env.corpus_tfidf, env.dictionary, env.n_topics)
+    elif model == 'lda':
+        env.models[model] = LdaModel(env.corpus_tfidf, env.dictionary, env.n_topics)
+    elif model == 'd2v':
+        env.models[model] = Doc2vecModel(list(env.texts), env.n_topics)
+    else:
+        env.models[model] = BigArtmModel(os.path.dirname(env.location), env.dictionary, env.n_topics)
+
+
+def query(env, model, batch):
+    if model not in env.models:
+        raise RuntimeError('%s is not built' % model)
+    queries = env.queries(model)
+    if batch:
+        env.models[model].get_similar_batch(queries)
+    else:
+        for q in queries:
+            env.models[model].get_similar(q)
+
+
+def benchmarks(env):
+    """name -> (function, number of items it processes, whether it's slow enough to run once)"""
+    from recommenders.models import Tokenizer
+    from recommenders.util import load_uci
+    from text_processing.base import preprocess
+
+    n_queries = len(env.query_ids)
+    texts = list(env.texts)
+    result = {
+        'preprocess': (lambda: [preprocess(text) for text in env.raw], len(env.raw), False),
+        'tokenize': (lambda: [Tokenizer.tokenize(text) for text in texts], len(texts), False),
+        'doc2bow': (lambda: [Tokenizer.doc2bow(text, env.dictionary) for text in texts], len(texts), False),
+        'load_uci': (lambda: load_uci(env.location), 1, False),
+        'tfidf': (lambda: env.tfidf[env.corpus], len(env.corpus), False),
+        'docstore_read': (lambda: [env.texts[i] for i in env.query_ids], n_queries, False),
+    }
+    for model in MODELS:
+        result[model + '.build'] = (lambda model=model: build(env, model), len(env.corpus), True)
+        result[model + '.query'] = (lambda model=model: query(env, model, False), n_queries, False)
+        result[model + '.query_batch'] = (lambda model=model: query(env, model, True), n_queries, False)
+    return result
+
+
+def measure(fn, items, repeat):
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        t0 = perf_counter()
+        fn()
+        times.append(perf_counter() - t0)
+    return {'seconds': times, 'median': median(times), 'min': min(times), 'items': items,
+            'ms_per_item': 1000 * median(times) / items, 'items_per_sec': items / max(median(times), 1e-12)}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='benchmark-')
+    print("corpus of %d documents in %s" % (args.docs, workdir))
+    env = Env(workdir, args.docs, args.seed, args.topics)
+
+    results = {}
+    only = set(args.only.split(',')) if args.only else None
+    for name, (fn, items, slow) in benchmarks(env).items():
+        if only and name not in only and name.split('.')[0] not in only:
+            continue
+        try:
+            results[name] = measure(fn, items, 1 if slow else args.repeat)
+            print("%-18s %10.3f ms %12.1f items/s" % (name, 1000 * results[name]['median'],
+                                                      results[name]['items_per_sec']))
+        except Exception as e:
+            results[name] = {'error': '%s: %s' % (type(e).__name__, e)}
+            print("%-18s failed: %s" % (name, results[name]['error']))
+
+    report = {
+        'meta': {'docs': args.docs, 'seed': args.seed, 'topics': args.topics, 'repeat': args.repeat,
+                 'time': strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(), 'python': platform.python_version(),
+                 'numpy': np.__version__, 'cpus': os.cpu_count(), 'machine': platform.machine()},
+        'results': results,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("results written to %s" % args.out)
+
+
+def compare(base_path, new_path, threshold):
+    """Prints the change of every benchmark's median time and returns the names of the regressions"""
+    with open(base_path, 'r') as f:
+        base = json.load(f)
+    with open(new_path, 'r') as f:
+        new = json.load(f)
+    for key in ['docs', 'seed', 'topics']:
+        if base['meta'].get(key) != new['meta'].get(key):
+            print("WARNING: runs differ in %s (%s vs %s)" % (key, base['meta'].get(key), new['meta'].get(key)))
+
+    regressions = []
+    for name in sorted(set(base['results']) | set(new['results'])):
+        old, cur = base['results'].get(name, {}), new['results'].get(name, {})
+        if 'median' not in old or 'median' not in cur:
+            print("%-18s %s" % (name, 'skipped: ' + (cur.get('error') or old.get('error') or 'missing in one run')))
+            continue
+        ratio = cur['median'] / max(old['median'], 1e-12)
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            flag = 'faster'
+        print("%-18s %10.3f ms -> %10.3f ms %+7.1f%% %s" % (
+            name, 1000 * old['median'], 1000 * cur['median'], 100 * (ratio - 1), flag))
+    print("%d regressions over %.0f%%" % (len(regressions), 100 * threshold))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--docs', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--topics', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', help='comma separated benchmark names or models')
+    parser.add_argument('--workdir', help='where corpora are written, one of the same size and seed is reused')
+    parser.add_argument('--out', default='benchmark.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'))
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        return 1 if compare(args.compare[0], args.compare[1], args.threshold) else 0
+    run(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    LRU cache of similarity results, keyed by a hash of the query text, the corpus document it is (if any,
+    Doc2vec answers those from the document's trained vector) and the version of the models.
+    Entries are evicted once their total pickled size exceeds `max_bytes`
+    """
+    def __init__(self, max_bytes, version=''):
+        self.max_bytes = max_bytes
+        self.version = version
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, text, doc_id=None):
+        doc = '' if doc_id is None else str(int(doc_id))
+        return hashlib.sha1('\0'.join([self.version, doc, text]).encode('utf-8')).hexdigest()
+
+    def get(self, text, doc_id=None):
+        key = self.key(text, doc_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return pickle.loads(entry)
+
+    def put(self, text, value, doc_id=None):
+        entry = pickle.dumps(value)
+        if len(entry) > self.max_bytes:
+            return
+        key = self.key(text, doc_id)
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = entry
+            self.size += len(entry)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses}
+
+    def save(self, path):
+        """Web workers save to the same path on exit, each through its own temporary file; the last one wins"""
+        with self.lock:
+            state = {'version': self.version, 'entries': list(self.entries.items())}
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path) + '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(state, f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def load(self, path):
+        """Restores entries saved for the same model version, most recently used last. A broken file is ignored"""
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+            version, entries = state['version'], state['entries']
+        except Exception:  # truncated by a crash, or not a cache at all
+            logging.exception('Result cache at %s is unreadable, starting with an empty one' % path)
+            return
+        if version != self.version:
+            logging.info('Result cache at %s is for other models, ignored' % path)
+            return
+        for key, entry in entries:
+            self.entries[key] = entry
+            self.size += len(entry)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
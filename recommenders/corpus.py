@@ -0,0 +1,181 @@
+"""
+Bag-of-words corpus stored as a CSR matrix: indptr/indices/data .npy files in a recommenders.storage directory,
+which are memory-mapped on load. Replaces the UCI text format, which had to be parsed line by line
+"""
+import os
+import sys
+from time import time
+
+import numpy as np
+import scipy.sparse
+
+from recommenders import storage
+
+
+def pack(bows, offset=0):
+    """indptr (without the leading offset), indices and data of a list of bag-of-words"""
+    lengths = np.fromiter((len(bow) for bow in bows), dtype=np.int64, count=len(bows))
+    pairs = [pair for bow in bows for pair in sorted(bow)]
+    indices = np.fromiter((i for i, _ in pairs), dtype=np.int32, count=len(pairs))
+    data = np.fromiter((w for _, w in pairs), dtype=np.float32, count=len(pairs))
+    return offset + np.cumsum(lengths), indices, data
+
+
+class CsrCorpus:
+    """
+    Documents x terms sparse matrix, which iterates and indexes like a gensim corpus of (term id, weight) lists
+    """
+    CHUNKSIZE = 4096
+
+    def __init__(self, indptr, indices, data, num_terms):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.num_terms = num_terms
+
+    @staticmethod
+    def from_matrix(matrix):
+        matrix = scipy.sparse.csr_matrix(matrix)
+        return CsrCorpus(matrix.indptr, matrix.indices, matrix.data, matrix.shape[1])
+
+    @staticmethod
+    def from_bows(bows, num_terms):
+        indptr, indices, data = pack(list(bows))
+        return CsrCorpus(np.concatenate([[0], indptr]), indices, data, num_terms)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def rows(self, start, stop):
+        """Documents start..stop as a scipy CSR matrix; the arrays are slices, not copies"""
+        a, b = self.indptr[start], self.indptr[stop]
+        return scipy.sparse.csr_matrix((self.data[a:b], self.indices[a:b], self.indptr[start:stop + 1] - a),
+                                       shape=(stop - start, self.num_terms), copy=False)
+
+    @property
+    def matrix(self):
+        return self.rows(0, len(self))
+
+    def __getitem__(self, item):
+        a, b = self.indptr[item], self.indptr[item + 1]
+        return list(zip(self.indices[a:b].tolist(), self.data[a:b].tolist()))
+
+    def __iter__(self):
+        for start in range(0, len(self), self.CHUNKSIZE):
+            indptr = self.indptr[start:start + self.CHUNKSIZE + 1].tolist()
+            indices = self.indices[indptr[0]:indptr[-1]].tolist()
+            data = self.data[indptr[0]:indptr[-1]].tolist()
+            for a, b in zip(indptr, indptr[1:]):
+                yield list(zip(indices[a - indptr[0]:b - indptr[0]], data[a - indptr[0]:b - indptr[0]]))
+
+    def _params(self):
+        return {'num_terms': self.num_terms}
+
+    def save(self, path):
+        storage.save(path, type(self).__name__, {'indptr': self.indptr, 'indices': self.indices, 'data': self.data},
+                     self._params())
+
+    @staticmethod
+    def load(path, mmap_mode='r'):
+        arrays, params = storage.load(path, CsrCorpus.__name__, mmap_mode)
+        return CsrCorpus(arrays['indptr'], arrays['indices'], arrays['data'], params['num_terms'])
+
+    @staticmethod
+    def write(path, bows, num_terms, chunksize=10000):
+        """Writes a stream of bag-of-words to `path` chunk by chunk, without keeping it in memory"""
+        os.makedirs(path, exist_ok=True)
+        corpus = CsrCorpus(np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32),
+                           num_terms)
+        corpus.save(path)
+        corpus = CsrCorpus.load(path)
+
+        chunk = []
+        for bow in bows:
+            chunk.append(bow)
+            if len(chunk) == chunksize:
+                corpus.append(path, chunk)
+                chunk = []
+        if chunk:
+            corpus.append(path, chunk)
+        return corpus
+
+    def _append_array(self, path, name, rows):
+        appended = storage.append_rows(os.path.join(path, name + '.npy'), rows)
+        if appended is None:
+            storage.save_array(path, name, np.concatenate([getattr(self, name), rows]))
+            appended = np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        setattr(self, name, appended)
+
+    def append(self, path, bows):
+        """
+        Appends documents (bag-of-words or a CsrCorpus) in place to the corpus stored at `path`,
+        which this corpus must be loaded from
+        """
+        if isinstance(bows, CsrCorpus):
+            indptr = int(self.indptr[-1]) + np.asarray(bows.indptr[1:] - bows.indptr[0], dtype=np.int64)
+            indices, data = bows.indices.astype(np.int32), bows.data.astype(np.float32)
+        else:
+            indptr, indices, data = pack(bows, int(self.indptr[-1]))
+        self._append_array(path, 'indices', indices)
+        self._append_array(path, 'data', data)
+        self._append_array(path, 'indptr', indptr)  # the last one, until then readers see the old documents only
+        if len(indices):
+            self.num_terms = max(self.num_terms, int(indices.max()) + 1)
+        storage.save_manifest(path, type(self).__name__, ['indptr', 'indices', 'data'], self._params())
+
+
+class Tfidf:
+    """
+    Same weights as gensim's TfidfModel(dictionary=dictionary, smartirs='ntc') as sparse matrix operations:
+    raw counts times log2((N + 1) / df), documents normalised to unit length
+    """
+    EPS = 1e-12
+
+    def __init__(self, dictionary):
+        """`dictionary` is a gensim Dictionary or a recommenders.vocab.Vocabulary, which keeps dfs in an array"""
+        if isinstance(dictionary.dfs, np.ndarray):
+            dfs = np.asarray(dictionary.dfs, dtype=np.float64)
+        else:
+            dfs = np.zeros(len(dictionary))
+            dfs[list(dictionary.dfs)] = list(dictionary.dfs.values())
+        with np.errstate(divide='ignore'):
+            self.idf = np.where(dfs > 0, np.log2((dictionary.num_docs + 1.0) / dfs), 0)
+
+    def transform(self, matrix):
+        """TF-IDF of a CSR matrix of counts, as a new CSR matrix"""
+        matrix = scipy.sparse.csr_matrix(matrix, dtype=np.float64, copy=True)
+        known = matrix.indices < len(self.idf)  # terms added to the corpus after the dictionary get no weight
+        matrix.data[known] *= self.idf[matrix.indices[known]]
+        matrix.data[~known] = 0
+
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        matrix.data /= np.repeat(norms, np.diff(matrix.indptr))
+        matrix.data[np.abs(matrix.data) <= self.EPS] = 0
+        matrix.eliminate_zeros()
+        return matrix
+
+    def write(self, corpus: CsrCorpus, path, chunksize=100000):
+        """TF-IDF of a whole corpus written to `path` chunk by chunk, for corpora which don't fit in memory"""
+        out = CsrCorpus.write(path, [], len(self.idf))
+        for start in range(0, len(corpus), chunksize):
+            chunk = CsrCorpus.from_matrix(self.transform(corpus.rows(start, min(start + chunksize, len(corpus)))))
+            out.append(path, chunk)
+        return out
+
+    def __getitem__(self, doc):
+        """TF-IDF of a CsrCorpus as an in-memory CsrCorpus, or of a single bag-of-words as a list"""
+        if isinstance(doc, CsrCorpus):
+            return CsrCorpus.from_matrix(self.transform(doc.matrix))
+        return CsrCorpus.from_matrix(self.transform(CsrCorpus.from_bows([doc], len(self.idf)).matrix))[0]
+
+
+if __name__ == '__main__':
+    # converts a corpus saved in the UCI format by an earlier version
+    from gensim.corpora import UciCorpus
+    from recommenders.util import load
+
+    location = sys.argv[-1] if len(sys.argv) > 1 else '../out/corpus.uci'
+    t0 = time()
+    CsrCorpus.write(location + '.csr', UciCorpus(location), len(load(location + '.dict.pickle')))
+    print("converted %s in %.3fs" % (location, time() - t0))
@@ -34,14 +34,18 @@ def fill_db(metadata=None, data_samples=None):
     if data_samples is None:
         from .webapp import data_samples
 
-    for doc_id in range(len(data_samples)):
+    # only documents which are not in the database yet, so that it can be re-run after an ingest
+    last_id = db.session.query(db.func.max(Document.id)).scalar()
+    for doc_id in range(0 if last_id is None else last_id + 1, len(data_samples)):
+        meta = metadata[doc_id]
+        # the metadata store has '' for missing fields, they must stay NULL in the unique columns
         doc = Document(
             id=doc_id,
             processed_text=data_samples[doc_id],
-            kad_case_num=metadata[doc_id]['case_num'],
-            kad_case_id=metadata[doc_id]['case_id'],
-            kad_doc_id=metadata[doc_id]['doc_id'],
-            kad_doc_name=metadata[doc_id]['doc_name']
+            kad_case_num=meta['case_num'] or None,
+            kad_case_id=meta['case_id'] or None,
+            kad_doc_id=meta['doc_id'] or None,
+            kad_doc_name=meta['doc_name'] or None
         )
         db.session.add(doc)
 
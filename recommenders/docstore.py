@@ -0,0 +1,140 @@
+"""
+Packed store of document texts: all texts in one append-only byte array with an offset index, both memory-mapped.
+Texts may be zlib-compressed in blocks of consecutive documents
+"""
+import os
+import sys
+import zlib
+from functools import lru_cache
+from time import time
+
+import numpy as np
+
+from recommenders import storage
+from recommenders.metrics import DOC_READS, DOC_READ_BYTES, BLOCK_READS
+
+ARRAYS = ['data', 'offsets', 'blocks', 'block_offsets']
+
+
+def read_text(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+class DocStore:
+    """
+    Document texts by id. `offsets` delimit the (uncompressed) texts in document order.
+    In a compressed store `data` holds zlib blocks: block b covers documents blocks[b]..blocks[b + 1]
+    and its bytes are data[block_offsets[b]:block_offsets[b + 1]]
+    """
+    CACHED_BLOCKS = 64
+
+    def __init__(self, data, offsets, blocks, block_offsets, block_size=0):
+        self.data = data
+        self.offsets = offsets
+        self.blocks = blocks
+        self.block_offsets = block_offsets
+        self.block_size = block_size
+        self.block = lru_cache(self.CACHED_BLOCKS)(self._block)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _block(self, b):
+        BLOCK_READS.inc()
+        return zlib.decompress(self.data[self.block_offsets[b]:self.block_offsets[b + 1]])
+
+    def raw(self, item):
+        """utf-8 bytes of a document; a slice of the memory map, not a copy, if the store isn't compressed"""
+        if not 0 <= item < len(self):
+            raise IndexError(item)
+        DOC_READS.inc(compressed='true' if self.block_size else 'false')
+        DOC_READ_BYTES.inc(int(self.offsets[item + 1] - self.offsets[item]))
+        if not self.block_size:
+            return memoryview(self.data[self.offsets[item]:self.offsets[item + 1]])
+        b = int(np.searchsorted(self.blocks, item, side='right')) - 1
+        start = self.offsets[self.blocks[b]]
+        return memoryview(self.block(b))[self.offsets[item] - start:self.offsets[item + 1] - start]
+
+    def __getitem__(self, item):
+        return str(self.raw(item), 'utf-8')
+
+    def __iter__(self):
+        """Sequential iteration, decompressing every block once"""
+        if not self.block_size:
+            for i in range(len(self)):
+                yield self[i]
+            return
+        for b in range(len(self.blocks) - 1):
+            block = self._block(b)
+            start = self.offsets[self.blocks[b]]
+            for i in range(self.blocks[b], self.blocks[b + 1]):
+                yield str(block[self.offsets[i] - start:self.offsets[i + 1] - start], 'utf-8')
+
+    def _params(self):
+        return {'block_size': self.block_size}
+
+    @staticmethod
+    def load(path, mmap_mode='r'):
+        arrays, params = storage.load(path, DocStore.__name__, mmap_mode)
+        return DocStore(*[arrays[name] for name in ARRAYS], **params)
+
+    @staticmethod
+    def write(path, texts, block_size=0, chunksize=1000):
+        """
+        Writes a stream of texts to `path` without keeping them in memory.
+        With a non-zero `block_size` texts are compressed in blocks of that many documents
+        """
+        os.makedirs(path, exist_ok=True)
+        for name, dtype in zip(ARRAYS, [np.uint8, np.int64, np.int64, np.int64]):
+            storage.save_array(path, name, np.zeros(0 if name == 'data' else 1, dtype=dtype))
+        storage.save_manifest(path, DocStore.__name__, ARRAYS, {'block_size': block_size})
+        store = DocStore.load(path)
+
+        chunk = []
+        for text in texts:
+            chunk.append(text)
+            if len(chunk) == max(chunksize, block_size):
+                store.append(path, chunk)
+                chunk = []
+        if chunk:
+            store.append(path, chunk)
+        return store
+
+    def _append_array(self, path, name, rows):
+        appended = storage.append_rows(os.path.join(path, name + '.npy'), rows)
+        if appended is None:
+            storage.save_array(path, name, np.concatenate([getattr(self, name), rows]))
+            appended = np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        setattr(self, name, appended)
+
+    def append(self, path, texts):
+        """Appends texts in place to the store at `path`, which this store must be loaded from"""
+        encoded = [text.encode('utf-8') for text in texts]
+        offsets = int(self.offsets[-1]) + np.cumsum([len(e) for e in encoded], dtype=np.int64)
+        if not self.block_size:
+            self._append_array(path, 'data', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        else:
+            # every append starts a new block, so that existing blocks are never rewritten
+            blocks = [zlib.compress(b''.join(encoded[i:i + self.block_size]))
+                      for i in range(0, len(encoded), self.block_size)]
+            self._append_array(path, 'data', np.frombuffer(b''.join(blocks), dtype=np.uint8))
+            self._append_array(path, 'block_offsets',
+                               int(self.block_offsets[-1]) + np.cumsum([len(b) for b in blocks], dtype=np.int64))
+            self._append_array(path, 'blocks', np.minimum(
+                np.arange(len(self), len(self) + len(encoded), self.block_size) + self.block_size,
+                len(self) + len(encoded)))
+        self._append_array(path, 'offsets', offsets)  # the last one, until then readers see the old documents only
+        self.block.cache_clear()
+
+
+if __name__ == '__main__':
+    # packs the preprocessed texts of an existing corpus
+    import recommenders.webapp_config as conf
+    from recommenders.util import load
+
+    location = sys.argv[-1] if len(sys.argv) > 1 else conf.DOCS_LOCATION
+    t0 = time()
+    paths = load(location + '.docs.pickle')
+    DocStore.write(location + '.docs', (read_text(p) for p in paths), conf.DOCS_BLOCK_SIZE)
+    print("packed %d documents in %.3fs" % (len(paths), time() - t0))
@@ -1,96 +1,160 @@
 import json
+import os
 import sys
 from collections import defaultdict
+from multiprocessing import Pool
 
-import math
 import numpy as np
-from gensim.models import TfidfModel
+import scipy.sparse
 
+from recommenders.corpus import Tfidf
 from recommenders.db import Rating
 from recommenders.util import load_uci
 
 
 class Evaluator:
-
+    """
+    Offline metrics against the ratings in the database. Relevance of recommendation j for test document i is
+    relevance[i, j]: positive if it's relevant, negative if not, 0 if unknown
+    """
     top_n = 20
 
     def __init__(self, cut_off=20):
-        ratings = Rating.query.all()
-        self.test_data = defaultdict(lambda: defaultdict(int))
-        for r in ratings:
-            self.test_data[r.doc_id][r.recommendation_id] = r.value
+        ratings = {}
+        for r in Rating.query.all():
+            ratings.setdefault(r.doc_id, {})[r.recommendation_id] = r.value
             #  relevance is usually reciprocal
-            self.test_data[r.recommendation_id].setdefault(r.doc_id, r.value)
+            ratings.setdefault(r.recommendation_id, {}).setdefault(r.doc_id, r.value)
 
         # Remove test entries with too little recommendation data
-        for k in list(self.test_data.keys()):
-            if len(self.test_data[k]) < cut_off:
-                del self.test_data[k]
+        ratings = {k: v for k, v in ratings.items() if len(v) >= cut_off}
+
+        self.test_ids = np.asarray(list(ratings), dtype=np.int64)
+        rows = np.repeat(np.arange(len(ratings)), [len(v) for v in ratings.values()])
+        cols = [rec for v in ratings.values() for rec in v]
+        values = [value for v in ratings.values() for value in v.values()]
+        n_docs = max(cols, default=-1) + 1
+        self.relevance = scipy.sparse.csr_matrix((values, (rows, cols)), shape=(len(ratings), n_docs))
+
+    def recommendations(self, model, corpus):
+        """Top-n recommendations for every test document, queried in batches; -1 pads rows shorter than top_n"""
+        recs = np.full((len(self.test_ids), self.top_n), -1, dtype=np.int64)
+        docs = [corpus[k] for k in self.test_ids.tolist()]
+        for i, row in enumerate(model.get_similar_batch(docs, self.top_n)):
+            recs[i, :len(row)] = row
+        return recs
+
+    def scores(self, recs):
+        """Relevance of every recommendation, 0 for unknown ones and padding"""
+        rows = np.repeat(np.arange(len(recs)), recs.shape[1])
+        cols = recs.ravel()
+        known = (cols >= 0) & (cols < self.relevance.shape[1])
+        scores = np.zeros(len(cols))
+        scores[known] = np.asarray(self.relevance[rows[known], cols[known]]).ravel()
+        return scores.reshape(recs.shape)
 
     def evaluate(self, model, corpus):
+        recs = self.recommendations(model, corpus)
+        scores, valid = self.scores(recs), recs >= 0
         return {
-            'map': self.map_score(model, corpus),
-            'map_known': self.map_score_known(model, corpus),
-            'mean_p_at_k': self.mean_precision_at_k(model, corpus),
-            'mean_p_at_k_known': self.mean_precision_at_k(model, corpus, True),
-            'mean_dcg': self.mean_dcg(model, corpus),
-            'mean_dcg_known': self.mean_dcg(model, corpus, True),
+            'map': self.average_precision(scores, valid).mean(),
+            'map_known': np.nanmean(self.average_precision(scores, valid, True)),
+            'mean_p_at_k': np.nanmean(self.precision(scores, valid)),
+            'mean_p_at_k_known': np.nanmean(self.precision(scores, valid, True)),
+            'mean_dcg': np.nanmean(self.dcg(scores, valid)),
+            'mean_dcg_known': np.nanmean(self.dcg(scores, valid, True)),
         }
 
     @staticmethod
-    def precision(recs: [int], test_scores, remove_unknown=False):
-        if remove_unknown:
-            recs = [rec for rec in recs if test_scores[rec] != 0]
-        return np.average([test_scores[rec] > 0 for rec in recs])
+    def precision(scores, valid, remove_unknown=False):
+        """Precision of every row of recommendations, nan if there is nothing to count"""
+        counted = valid & (scores != 0) if remove_unknown else valid
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return ((scores > 0) & counted).sum(axis=1) / counted.sum(axis=1)
 
     @staticmethod
-    def average_precision_score(recs: [int], test_scores: dict, remove_unknown=False):
-        k_values = range(1, len(recs))
+    def average_precision(scores, valid, remove_unknown=False):
+        """
+        Mean of P@k * rel(k) over k = 1..n-1 of every row, only over k with a known rel(k) if remove_unknown.
+        P@k counts unknown items as irrelevant either way
+        """
+        rel = (scores > 0) & valid
+        n = valid.sum(axis=1, keepdims=True)
+        ks = np.arange(1, scores.shape[1] + 1)
+        counted = ks < n  # the last recommendation is not counted
         if remove_unknown:
-            # Remove values for which rel(k) is unknown
-            k_values = [k for k in k_values if test_scores[recs[k-1]] != 0]
-
-        precisions = [Evaluator.precision(recs[:k], test_scores) for k in k_values]
-        rel = [test_scores[recs[k-1]] > 0 for k in k_values]
-        return np.multiply(precisions, rel).mean()
+            counted &= scores != 0
+        p_at_k = np.cumsum(rel, axis=1) / ks
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (p_at_k * rel * counted).sum(axis=1) / counted.sum(axis=1)
 
     @staticmethod
-    def dcg(recs: [int], test_scores, remove_unknown=False):
-        if remove_unknown:
-            recs = [rec for rec in recs if test_scores[rec] != 0]
-        return sum([(test_scores[rec] > 0) / math.log2(i+2) for i,rec in enumerate(recs)])
-
-    def mean_precision_at_k(self, model, corpus, remove_unknown=False):
-        a = np.asarray([
-            self.precision(model.get_similar(corpus[k], self.top_n), v, remove_unknown)
-            for k, v in self.test_data.items()
-        ])
-        return a[a == a].mean()  # filter out nan values
-
-    def map_score(self, model, corpus):
-        """Mean Average Precision score"""
-        return np.average([
-            self.average_precision_score(model.get_similar(corpus[k], self.top_n), v) for k, v in self.test_data.items()
-        ])
-
-    def map_score_known(self, model, corpus):
-        """mAP score only for known items"""
-        ap_scores = np.asarray([
-            self.average_precision_score(model.get_similar(corpus[k], self.top_n), v, True)
-            for k, v in self.test_data.items()
-        ])
-        return ap_scores[ap_scores == ap_scores].mean()  # filter out nan values
-
-    def mean_dcg(self, model, corpus, remove_unknown=False):
-        a = np.asarray([
-            self.dcg(model.get_similar(corpus[k], self.top_n), v, remove_unknown)
-            for k, v in self.test_data.items()
-        ])
-        return a[a == a].mean()  # filter out nan values
+    def dcg(scores, valid, remove_unknown=False):
+        """Discounted cumulative gain of every row; with remove_unknown, unknown items don't take up positions"""
+        counted = valid & (scores != 0) if remove_unknown else valid
+        positions = np.cumsum(counted, axis=1)  # 1-based rank among the counted items
+        with np.errstate(divide='ignore'):
+            return np.where((scores > 0) & counted, 1 / np.log2(positions + 1), 0).sum(axis=1)
+
+
+_sweep = {}  # inputs of the topic count sweep, inherited by the forked pool workers
+
+
+def sweep_lsi(t_values, checkpoint):
+    """
+    LSI ranks are nested: it's trained once at the largest rank and the smaller ones are its truncations.
+    The score of every rank is appended to `checkpoint` as soon as it's computed, see load_checkpoint
+    """
+    from recommenders.models import LsiModel
+    model = LsiModel(_sweep['corpus'], _sweep['dictionary'], max(t_values))
+    results = []
+    for t in t_values:
+        results.append(('lsi', t, _sweep['evaluator'].evaluate(model.truncated(t), _sweep['corpus'])))
+        with open(checkpoint, 'a') as f:
+            f.write(json.dumps(results[-1]) + '\n')
+    return results
+
+
+def load_checkpoint(scores, checkpoint):
+    """Adds the scores of a task which was interrupted before it returned; a partly written last line is skipped"""
+    if not os.path.exists(checkpoint):
+        return
+    with open(checkpoint, 'r') as f:
+        for line in f:
+            try:
+                family, t, score = json.loads(line)
+            except ValueError:
+                continue
+            scores[family][str(t)] = score
+
+
+def sweep_point(family, t):
+    from recommenders.models import LdaModel, Doc2vecModel, BigArtmModel
+    import recommenders.webapp_config as conf
+
+    if family == 'lda':
+        model, docs = LdaModel(_sweep['corpus'], _sweep['dictionary'], t), _sweep['corpus']
+    elif family == 'd2v':
+        model, docs = Doc2vecModel(_sweep['data_samples'], t), _sweep['data_samples']
+    else:
+        model = BigArtmModel(conf.UCI_FOLDER, _sweep['dictionary'], t,
+                             target_folder=conf.UCI_FOLDER + '/artm_batches_%d' % t)
+        docs = _sweep['corpus']
+    return [(family, t, _sweep['evaluator'].evaluate(model, docs))]
+
+
+def run_task(task):
+    fn, args = task
+    return fn(*args)
+
+
+def save_scores(scores, path):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(scores, f)
+    os.replace(path + '.tmp', path)
 
 
 if __name__ == '__main__':
-    from recommenders.models import LsiModel, LdaModel, Doc2vecModel, BigArtmModel
     import recommenders.webapp_config as conf
 
     lsi_on = '--lsi' in sys.argv
@@ -101,34 +165,42 @@ if __name__ == '__main__':
 
     evaluator = Evaluator()
     scores = defaultdict(dict)
+    scores_path = './scores.json'
+    if os.path.exists(scores_path):
+        # resume an interrupted sweep: points which are already there are skipped
+        with open(scores_path, 'r') as f:
+            scores.update(json.load(f))
+    lsi_checkpoint = scores_path + '.lsi.jsonl'
+    load_checkpoint(scores, lsi_checkpoint)
 
     corpus, data_samples, dictionary, metadata = load_uci(conf.DOCS_LOCATION)
-    tfidf = TfidfModel(dictionary=dictionary, smartirs='ntc')
     corpus_raw = corpus
-    corpus = [tfidf[doc] for doc in corpus]
+    corpus = Tfidf(dictionary)[corpus]
 
     if trained:
         import recommenders.webapp as webapp
 
         for k in ['lsi', 'lda', 'artm']:
-            scores['t'+k] = evaluator.evaluate(getattr(webapp, k), corpus)
-        scores['t_d2v'] = evaluator.evaluate(webapp.d2v, data_samples)
-        scores['t_artm_raw'] = evaluator.evaluate(webapp.artm, corpus_raw)
+            scores['t'+k] = evaluator.evaluate(webapp.models.get(k), corpus)
+        scores['t_d2v'] = evaluator.evaluate(webapp.models.get('d2v'), data_samples)
+        scores['t_artm_raw'] = evaluator.evaluate(webapp.models.get('artm'), corpus_raw)
 
         with open('./scores_trained.json', 'w') as f:
             json.dump(scores, f)
 
     t_values = [2**i for i in range(2, 8)] + list(range(100, 850, 50))
-    for t in t_values:
-        if lsi_on:
-            scores['lsi'][t] = evaluator.evaluate(LsiModel(corpus, dictionary, t), corpus)
-        if lda_on:
-            scores['lda'][t] = evaluator.evaluate(LdaModel(corpus, dictionary, t), corpus)
-        if d2v_on:
-            scores['d2v'][t] = evaluator.evaluate(Doc2vecModel(data_samples, t), data_samples)
-        if artm_on:
-            scores['artm'][t] = evaluator.evaluate(BigArtmModel(conf.UCI_FOLDER, dictionary, t), corpus)
+    todo = {family: [t for t in t_values if str(t) not in scores[family]]
+            for family, on in [('lsi', lsi_on), ('lda', lda_on), ('d2v', d2v_on), ('artm', artm_on)] if on}
+    tasks = [(sweep_lsi, (todo.pop('lsi'), lsi_checkpoint))] if todo.get('lsi') else []
+    tasks += [(sweep_point, (family, t)) for family, ts in todo.items() if family != 'lsi' for t in ts]
+
+    _sweep.update(corpus=corpus, data_samples=data_samples, dictionary=dictionary, evaluator=evaluator)
+    with Pool(conf.SWEEP_PROCESSES) as pool:
+        for results in pool.imap_unordered(run_task, tasks):
+            for family, t, score in results:
+                print(family, t, score)
+                scores[family][str(t)] = score
+            save_scores(scores, scores_path)
 
     print(scores)
-    with open('./scores.json', 'w') as f:
-        json.dump(scores, f)
+    save_scores(scores, scores_path)
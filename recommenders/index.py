@@ -0,0 +1,439 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import numpy as np
+from gensim import matutils, utils
+
+from recommenders import storage
+
+
+def unit_rows(m: np.ndarray):
+    return m / np.maximum(np.linalg.norm(m, axis=1, keepdims=True), 1e-12)
+
+
+def top_n(sims: np.ndarray, topn):
+    """Indices of the `topn` largest values in every row of `sims`, best first"""
+    topn = min(topn, sims.shape[1])
+    best = np.argpartition(-sims, topn - 1, axis=1)[:, :topn]
+    order = np.argsort(-np.take_along_axis(sims, best, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(best, order, axis=1)
+
+
+def append_array(array: np.ndarray, rows: np.ndarray):
+    """
+    `array` with `rows` added. An array memory-mapped from a whole .npy file is extended on disk in place,
+    otherwise the rows are added in memory
+    """
+    filename = storage.mapped_file(array)
+    appended = storage.append_rows(filename, rows) if filename else None
+    return np.concatenate([array, rows]) if appended is None else appended
+
+
+class DenseIndex:
+    """
+    Exact cosine similarity index over a dense matrix with unit-length rows.
+    The matrix may be a read-only memory map
+    """
+    def __init__(self, index: np.ndarray):
+        self.index = index
+
+    @staticmethod
+    def from_corpus(corpus, num_features, chunksize=256, dtype=np.float32):
+        index = np.empty((len(corpus), num_features), dtype=dtype)
+        pos = 0
+        for chunk in utils.chunkize_serial(corpus, chunksize):
+            index[pos:pos + len(chunk)] = unit_rows(matutils.corpus2dense(chunk, num_features, len(chunk), dtype).T)
+            pos += len(chunk)
+        return DenseIndex(index)
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def similarities(self, queries: np.ndarray):
+        return unit_rows(queries.astype(self.index.dtype, copy=False)) @ self.index.T
+
+    def query(self, queries: np.ndarray, topn):
+        """Returns ids and cosine similarities of the `topn` best rows for every query row"""
+        sims = self.similarities(queries)
+        ids = top_n(sims, topn)
+        return ids, np.take_along_axis(sims, ids, axis=1)
+
+    def rows(self, ids):
+        """Stored (unit length) vectors of documents"""
+        return np.asarray(self.index[np.asarray(ids)])
+
+    def append(self, vectors: np.ndarray):
+        """Adds rows for new documents, on disk in place if the index is memory-mapped (see append_array)"""
+        self.index = append_array(self.index, unit_rows(vectors).astype(self.index.dtype))
+
+    def arrays(self):
+        return {'index': self.index}
+
+    def params(self):
+        return {'kind': type(self).__name__}
+
+    @staticmethod
+    def restore(arrays):
+        return DenseIndex(arrays['index'])
+
+
+def spherical_kmeans(x: np.ndarray, k, n_iter=20, sample_size=100000, chunksize=4096, seed=0):
+    """K-means on unit vectors with cosine similarity, fitted on a random sample of rows"""
+    rng = np.random.RandomState(seed)
+    if len(x) > sample_size:
+        x = x[np.sort(rng.choice(len(x), sample_size, replace=False))]
+    x = np.asarray(x, dtype=np.float32)
+    centroids = x[rng.choice(len(x), k, replace=False)]
+
+    for _ in range(n_iter):
+        assignment = assign(x, centroids, chunksize)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, x)
+        empty = ~sums.any(axis=1)
+        sums[empty] = x[rng.choice(len(x), empty.sum(), replace=False)]
+        centroids = unit_rows(sums)
+    return centroids
+
+
+def assign(x: np.ndarray, centroids: np.ndarray, chunksize=4096):
+    return np.concatenate([
+        np.argmax(np.asarray(x[i:i + chunksize], dtype=centroids.dtype) @ centroids.T, axis=1)
+        for i in range(0, len(x), chunksize)
+    ])
+
+
+class IvfIndex:
+    """
+    Approximate cosine similarity index (inverted file).
+    Rows are clustered with spherical k-means and stored grouped by cluster; a query is scored
+    exactly against the rows of its `n_probe` closest clusters only.
+    More lists make queries faster, more probes make them more accurate
+    """
+    def __init__(self, index, ids, offsets, centroids, n_probe=16):
+        self.index = index
+        self.ids = ids
+        self.offsets = offsets
+        self.centroids = centroids
+        self.n_probe = n_probe
+
+    @staticmethod
+    def build(vectors: np.ndarray, n_lists, n_probe=16, **kwargs):
+        n_lists = min(n_lists, len(vectors))
+        centroids = spherical_kmeans(vectors, n_lists, **kwargs)
+        assignment = assign(vectors, centroids)
+        ids = np.argsort(assignment, kind='stable').astype(np.int32)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))]).astype(np.int64)
+        return IvfIndex(np.asarray(vectors)[ids], ids, offsets, centroids, n_probe)
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def query(self, queries: np.ndarray, topn):
+        queries = unit_rows(queries.astype(self.index.dtype, copy=False))
+        sizes = np.diff(self.offsets)
+        probe_order = np.argsort(-(queries @ self.centroids.T), axis=1)
+        topn = min(topn, len(self))
+
+        all_ids = np.empty((len(queries), topn), dtype=np.int64)
+        all_sims = np.empty((len(queries), topn), dtype=self.index.dtype)
+        for i, (query, order) in enumerate(zip(queries, probe_order)):
+            # probe at least n_probe lists, and enough of them to fill topn
+            n_lists = max(self.n_probe, np.searchsorted(np.cumsum(sizes[order]), topn) + 1)
+            rows = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in order[:n_lists]])
+            sims = self.index[rows] @ query
+            best = top_n(sims[np.newaxis], topn)[0]
+            all_ids[i] = self.ids[rows[best]]
+            all_sims[i] = sims[best]
+        return all_ids, all_sims
+
+    def rows(self, ids):
+        positions = np.empty(len(self.ids), dtype=np.int64)
+        positions[self.ids] = np.arange(len(self.ids))
+        return np.asarray(self.index[positions[np.asarray(ids)]])
+
+    def append(self, vectors: np.ndarray):
+        """Adds rows for new documents to the lists of their closest centroids. Centroids are not updated"""
+        rows = unit_rows(vectors).astype(self.index.dtype)
+        n_lists = len(self.centroids)
+        assignment = np.concatenate([np.repeat(np.arange(n_lists), np.diff(self.offsets)),
+                                     assign(rows, self.centroids)])
+        order = np.argsort(assignment, kind='stable')
+        self.index = np.concatenate([self.index, rows])[order]
+        self.ids = np.concatenate([self.ids, np.arange(len(self.ids), len(self.ids) + len(rows))])[order] \
+            .astype(np.int32)
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))]).astype(np.int64)
+
+    def arrays(self):
+        return {'index': self.index, 'index_ids': self.ids, 'index_offsets': self.offsets,
+                'index_centroids': self.centroids}
+
+    def params(self):
+        return {'kind': type(self).__name__, 'n_probe': self.n_probe}
+
+    @staticmethod
+    def restore(arrays, n_probe=16):
+        return IvfIndex(arrays['index'], arrays['index_ids'], arrays['index_offsets'], arrays['index_centroids'],
+                        n_probe)
+
+
+class ShardedIndex:
+    """
+    Exact cosine similarity index split into fixed-size shards, which are stored as .npy files and memory-mapped.
+    Shards are scanned in parallel and their top-n lists are merged, so memory use is bounded by the shard size
+    """
+    def __init__(self, shards, n_workers=None, shard_size=None):
+        self.shards = [DenseIndex(shard) for shard in shards]
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self.n_workers = n_workers or os.cpu_count()
+        self.shard_size = shard_size or len(self.shards[0])
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def shard_name(i):
+        return 'index_shard_%04d' % i
+
+    @staticmethod
+    def build(corpus, num_features, path, shard_size=50000, chunksize=256, dtype=np.float32):
+        """Writes the index into `path` shard by shard in a single streaming pass over the corpus"""
+        os.makedirs(path, exist_ok=True)
+        shards = []
+        buffer = np.empty((shard_size, num_features), dtype=dtype)
+        pos = 0
+
+        def flush():
+            name = ShardedIndex.shard_name(len(shards))
+            storage.save_array(path, name, buffer[:pos])
+            shards.append(np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+
+        for chunk in utils.chunkize_serial(corpus, chunksize):
+            rows = unit_rows(matutils.corpus2dense(chunk, num_features, len(chunk), dtype).T)
+            while len(rows):
+                n = min(len(rows), shard_size - pos)
+                buffer[pos:pos + n] = rows[:n]
+                rows = rows[n:]
+                pos += n
+                if pos == shard_size:
+                    flush()
+                    pos = 0
+        if pos or not shards:
+            flush()
+        return ShardedIndex(shards, shard_size=shard_size)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def index(self):
+        return np.concatenate([shard.index for shard in self.shards])
+
+    @property
+    def executor(self):
+        """Pool the shards are scanned on, created by the first query and shared by all of them"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.n_workers, thread_name_prefix='shard')
+            return self._executor
+
+    def query(self, queries: np.ndarray, topn):
+        def query_shard(i):
+            ids, sims = self.shards[i].query(queries, topn)
+            return ids + self.offsets[i], sims
+
+        if len(self.shards) == 1:
+            results = [query_shard(0)]
+        else:
+            results = list(self.executor.map(query_shard, range(len(self.shards))))
+
+        ids = np.concatenate([r[0] for r in results], axis=1)
+        sims = np.concatenate([r[1] for r in results], axis=1)
+        best = top_n(sims, topn)
+        return np.take_along_axis(ids, best, axis=1), np.take_along_axis(sims, best, axis=1)
+
+    def rows(self, ids):
+        ids = np.asarray(ids)
+        shards = np.searchsorted(self.offsets, ids, side='right') - 1
+        return np.asarray([self.shards[s].index[i - self.offsets[s]] for s, i in zip(shards, ids)])
+
+    def append(self, vectors: np.ndarray):
+        """Fills up the last shard in place, the rest of the rows go to new shards"""
+        last = self.shards[-1]
+        n = min(len(vectors), self.shard_size - len(last))
+        if n > 0:
+            last.append(vectors[:n])
+        for i in range(n, len(vectors), self.shard_size):
+            self.shards.append(DenseIndex(unit_rows(vectors[i:i + self.shard_size]).astype(last.index.dtype)))
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+
+    def arrays(self):
+        return {self.shard_name(i): shard.index for i, shard in enumerate(self.shards)}
+
+    def params(self):
+        return {'kind': type(self).__name__, 'n_shards': len(self.shards), 'shard_size': self.shard_size}
+
+    @staticmethod
+    def restore(arrays, n_shards, shard_size=None):
+        return ShardedIndex([arrays[ShardedIndex.shard_name(i)] for i in range(n_shards)], shard_size=shard_size)
+
+
+def quantize(rows: np.ndarray, dtype):
+    """
+    Codes and per-row scales of unit rows: float16 codes are the values themselves with a scale of 1,
+    int8 codes are the values divided by max(|row|) / 127
+    """
+    if np.dtype(dtype) == np.float16:
+        return rows.astype(np.float16), np.ones(len(rows), dtype=np.float32)
+    scales = np.maximum(np.abs(rows).max(axis=1), 1e-12).astype(np.float32) / 127
+    return np.round(rows / scales[:, np.newaxis]).astype(np.int8), scales
+
+
+class QuantizedIndex:
+    """
+    Cosine similarity index scored on float16 or int8 codes of the rows, 2 or 4 times smaller than float32.
+    The best `topn * rerank` candidates are rescored exactly against the float32 rows in `exact`, which are
+    read from the memory map for the candidates only and so don't have to stay in memory.
+    With rerank=0 or no exact rows the approximate similarities are returned
+    """
+    CHUNK_ROWS = 16384  # rows decoded at a time while scoring
+
+    def __init__(self, codes, scales, exact=None, rerank=4):
+        self.codes = codes
+        self.scales = scales
+        self.exact = exact
+        self.rerank = rerank
+
+    @staticmethod
+    def build(vectors: np.ndarray, dtype=np.int8, rerank=4, chunksize=65536):
+        """`vectors` should be unit rows, they are kept as the exact rows"""
+        parts = [quantize(np.asarray(vectors[i:i + chunksize], dtype=np.float32), dtype)
+                 for i in range(0, len(vectors), chunksize)]
+        codes = np.concatenate([p[0] for p in parts]) if parts else np.zeros((0, vectors.shape[1]), dtype=dtype)
+        scales = np.concatenate([p[1] for p in parts]) if parts else np.zeros(0, dtype=np.float32)
+        return QuantizedIndex(codes, scales, vectors, rerank)
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def approximate(self, queries: np.ndarray, topn):
+        """Ids and similarities of the `topn` best rows by their codes"""
+        ids, sims = [], []
+        for start in range(0, len(self), self.CHUNK_ROWS):
+            chunk = self.codes[start:start + self.CHUNK_ROWS]
+            chunk_sims = (queries @ chunk.T.astype(np.float32)) * self.scales[start:start + len(chunk)]
+            best = top_n(chunk_sims, topn)
+            ids.append(best + start)
+            sims.append(np.take_along_axis(chunk_sims, best, axis=1))
+        ids, sims = np.concatenate(ids, axis=1), np.concatenate(sims, axis=1)
+        best = top_n(sims, topn)
+        return np.take_along_axis(ids, best, axis=1), np.take_along_axis(sims, best, axis=1)
+
+    def query(self, queries: np.ndarray, topn):
+        queries = unit_rows(queries.astype(np.float32, copy=False))
+        topn = min(topn, len(self))
+        if not self.rerank or self.exact is None:
+            return self.approximate(queries, topn)
+
+        candidates, _ = self.approximate(queries, min(topn * self.rerank, len(self)))
+        unique, inverse = np.unique(candidates, return_inverse=True)
+        rows = np.asarray(self.exact[unique], dtype=np.float32)
+        sims = np.einsum('ijk,ik->ij', rows[inverse.reshape(candidates.shape)], queries)
+        best = top_n(sims, topn)
+        return np.take_along_axis(candidates, best, axis=1), np.take_along_axis(sims, best, axis=1)
+
+    def rows(self, ids):
+        ids = np.asarray(ids)
+        if self.exact is not None:
+            return np.asarray(self.exact[ids])
+        return np.asarray(self.codes[ids], dtype=np.float32) * self.scales[ids, np.newaxis]
+
+    def append(self, vectors: np.ndarray):
+        rows = unit_rows(vectors).astype(np.float32)
+        codes, scales = quantize(rows, self.codes.dtype)
+        self.codes = append_array(self.codes, codes)
+        self.scales = append_array(self.scales, scales)
+        if self.exact is not None:
+            self.exact = append_array(self.exact, rows.astype(self.exact.dtype))
+
+    def arrays(self):
+        arrays = {'index_codes': self.codes, 'index_scales': self.scales}
+        if self.exact is not None:
+            arrays['index'] = self.exact
+        return arrays
+
+    def params(self):
+        return {'kind': type(self).__name__, 'rerank': self.rerank}
+
+    @staticmethod
+    def restore(arrays, rerank=4):
+        return QuantizedIndex(arrays['index_codes'], arrays['index_scales'], arrays.get('index'), rerank)
+
+
+INDEX_TYPES = {cls.__name__: cls for cls in [DenseIndex, IvfIndex, ShardedIndex, QuantizedIndex]}
+
+
+def restore_index(arrays, params=None):
+    params = dict(params or {'kind': 'DenseIndex'})
+    return INDEX_TYPES[params.pop('kind')].restore(arrays, **params)
+
+
+def build_index(corpus, num_features, shard_dir=None, shard_size=None):
+    """In-memory DenseIndex, or a ShardedIndex written to `shard_dir` if a shard size is given"""
+    if shard_size:
+        return ShardedIndex.build(corpus, num_features, shard_dir, shard_size)
+    return DenseIndex.from_corpus(corpus, num_features)
+
+
+def rebuild_index(index, corpus, num_features, shard_dir=None):
+    """New index of the same kind and settings as `index` over `corpus`"""
+    if isinstance(index, ShardedIndex):
+        return ShardedIndex.build(corpus, num_features, shard_dir, index.shard_size)
+    dense = DenseIndex.from_corpus(corpus, num_features)
+    if isinstance(index, IvfIndex):
+        return IvfIndex.build(dense.index, len(index.centroids), index.n_probe)
+    if isinstance(index, QuantizedIndex):
+        return QuantizedIndex.build(dense.index, index.codes.dtype, index.rerank)
+    return dense
+
+
+def recall_report(exact, approx: IvfIndex, queries: np.ndarray, topn=20, n_probes=(1, 2, 4, 8, 16, 32, 64)):
+    """Recall@topn of `approx` against `exact` and query latency for a range of n_probe values"""
+    t0 = time()
+    expected, _ = exact.query(queries, topn)
+    report = [{'n_probe': None, 'recall': 1.0, 'ms_per_query': 1000 * (time() - t0) / len(queries)}]
+
+    saved_n_probe = approx.n_probe
+    for n_probe in n_probes:
+        approx.n_probe = n_probe
+        t0 = time()
+        found, _ = approx.query(queries, topn)
+        elapsed = time() - t0
+        recall = np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(expected.tolist(), found.tolist())])
+        report.append({'n_probe': n_probe, 'recall': float(recall), 'ms_per_query': 1000 * elapsed / len(queries)})
+    approx.n_probe = saved_n_probe
+    return report
+
+
+def quantization_report(exact, queries: np.ndarray, topn=20, dtypes=('float16', 'int8'), reranks=(0, 2, 4)):
+    """
+    Memory of the scored rows and top-`topn` overlap with `exact` (a DenseIndex) of quantized indexes,
+    without (rerank=0) and with exact reranking
+    """
+    t0 = time()
+    expected, _ = exact.query(queries, topn)
+    report = [{'dtype': str(exact.index.dtype), 'rerank': None, 'bytes': int(exact.index.nbytes), 'overlap': 1.0,
+               'ms_per_query': 1000 * (time() - t0) / len(queries)}]
+
+    for dtype in dtypes:
+        quantized = QuantizedIndex.build(exact.index, dtype)
+        for rerank in reranks:
+            quantized.rerank = rerank
+            t0 = time()
+            found, _ = quantized.query(queries, topn)
+            elapsed = time() - t0
+            overlap = np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(expected.tolist(), found.tolist())])
+            report.append({'dtype': dtype, 'rerank': rerank,
+                           'bytes': int(quantized.codes.nbytes + quantized.scales.nbytes), 'overlap': float(overlap),
+                           'ms_per_query': 1000 * elapsed / len(queries)})
+    return report
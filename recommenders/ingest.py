@@ -0,0 +1,125 @@
+"""
+Incremental ingest of newly downloaded documents, without retraining the models:
+
+    python -m recommenders.ingest [docs dir] [metadata .json]
+
+New documents are appended to the serialized corpus, the document store, the list of paths and the metadata.
+LSI is updated with them, the other models only infer their vectors; the vectors are appended to the indices.
+Once the added documents exceed RETRAIN_THRESHOLD of the trained ones, prepare_corpus and train_models are run instead.
+The database is updated with `flask fill_db`, neighbour tables have to be recomputed
+"""
+import json
+import logging
+import os
+import pickle
+import subprocess
+import sys
+from time import time
+
+import recommenders.webapp_config as conf
+from recommenders import storage
+from recommenders.corpus import CsrCorpus, Tfidf
+from recommenders.docstore import DocStore, read_text
+from recommenders.metadata import MetadataStore
+from recommenders.models import LsiModel, LdaModel, Doc2vecModel, BigArtmModel, Tokenizer
+from recommenders.prepare_corpus import list_corpus, vectorize
+from recommenders.util import load
+from text_processing.simple import cache_path
+
+
+def append_meta(location, meta_source, paths):
+    """Copies metadata of the documents at `paths` from the crawler output, unless it's already there"""
+    with open(location + '.meta.json', 'r') as f:
+        known = {json.loads(line)['case_id'] for line in f}
+    wanted = {os.path.splitext(os.path.basename(p))[0] for p in paths} - known
+
+    with open(meta_source, 'r') as src, open(location + '.meta.json', 'a') as out:
+        for line in src:
+            doc_meta = json.loads(line)
+            if doc_meta['case_id'] in wanted:
+                out.write(json.dumps(doc_meta, ensure_ascii=False) + '\n')
+                wanted.discard(doc_meta['case_id'])
+    if wanted:
+        logging.warning('No metadata for %d documents' % len(wanted))
+
+
+def load_state(location, n_docs):
+    if os.path.exists(location + '.ingest.json'):
+        with open(location + '.ingest.json', 'r') as f:
+            return json.load(f)
+    return {'trained_docs': n_docs, 'added_docs': 0}
+
+
+def save_state(location, state):
+    with open(location + '.ingest.json', 'w') as f:
+        json.dump(state, f)
+
+
+def saved_models():
+    """(class, path) of the models which have been trained"""
+    return [(cls, path) for cls, path in [(LsiModel, conf.LSI_PATH), (LdaModel, conf.LDA_PATH),
+                                          (Doc2vecModel, conf.D2V_PATH), (BigArtmModel, conf.ARTM_PATH)]
+            if os.path.exists(os.path.join(path, storage.MANIFEST))]
+
+
+def retrain(docs_dir, location):
+    flags = {LsiModel: '--lsi', LdaModel: '--lda', Doc2vecModel: '--d2v', BigArtmModel: '--artm'}
+    subprocess.check_call([sys.executable, '-m', 'recommenders.prepare_corpus', docs_dir, location])
+    subprocess.check_call([sys.executable, '-m', 'recommenders.train_models'] +
+                          [flags[cls] for cls, _ in saved_models()])
+    save_state(location, {'trained_docs': len(load(location + '.docs.pickle')), 'added_docs': 0})
+
+
+def ingest(docs_dir, meta_source, location=conf.DOCS_LOCATION):
+    paths = load(location + '.docs.pickle')
+    known = set(paths)
+    sources = [s for s in list_corpus(docs_dir) if cache_path(s) not in known]
+    if not sources:
+        print("nothing to ingest")
+        return
+    new_paths = [cache_path(s) for s in sources]
+    append_meta(location, meta_source, new_paths)
+
+    state = load_state(location, len(paths))
+    if state['added_docs'] + len(sources) > conf.RETRAIN_THRESHOLD * state['trained_docs']:
+        print("%d documents added since the last training, retraining" % (state['added_docs'] + len(sources)))
+        retrain(docs_dir, location)
+        return
+
+    t0 = time()
+    dictionary = load(location + '.dict.pickle')
+    Tokenizer.load_stems(conf.STEMS_PATH)
+    bows = CsrCorpus.from_bows(vectorize(sources, dictionary), len(dictionary))
+    corpus = CsrCorpus.load(location + '.csr')
+    corpus.append(location + '.csr', bows)
+    texts = [read_text(p) for p in new_paths]
+    DocStore.load(location + '.docs').append(location + '.docs', texts)
+    with open(location + '.docs.pickle', 'wb') as f:
+        pickle.dump(paths + new_paths, f)
+    MetadataStore.from_json(location + '.meta.json', paths + new_paths).save(location + '.meta')
+    print("appended %d documents to the corpus in %.3fs" % (len(bows), time() - t0))
+
+    tfidf = Tfidf(dictionary)
+    for cls, path in saved_models():
+        t0 = time()
+        model = cls.load(path, dictionary=dictionary)
+        if cls is LsiModel:
+            model.add_documents(tfidf[bows], tfidf[corpus], path)
+        elif cls is Doc2vecModel:
+            model.add_documents(texts)
+        elif cls is BigArtmModel:
+            model.add_documents(bows)
+        else:
+            model.add_documents(tfidf[bows])
+        model.save(path)
+        print("%s: %d documents added in %.3fs" % (cls.__name__, len(bows), time() - t0))
+
+    state['added_docs'] += len(sources)
+    save_state(location, state)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+    docs_dir = sys.argv[-2] if len(sys.argv) > 2 else '../out/docs_simple2'
+    meta_source = sys.argv[-1] if len(sys.argv) > 1 else '../out/docs_simple4.json'
+    ingest(docs_dir, meta_source)
@@ -0,0 +1,116 @@
+import json
+import logging
+import os
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+JOB_ID = re.compile(r'[0-9a-f]{32}')
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    """
+    Runs jobs on a bounded pool of worker threads and keeps their outcome for `ttl` seconds.
+    At most `max_pending` jobs may wait or run at a time in this process, submit raises QueueFull beyond that.
+
+    With a `folder`, the state of every job is also written there as <job id>.json, so that any process sharing
+    the folder (every gunicorn worker) can read a job another one runs. Results must be json serializable then
+    """
+    def __init__(self, workers=2, max_pending=32, ttl=3600, folder=None):
+        self.executor = ThreadPoolExecutor(workers)
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.folder = folder
+        self.jobs = {}  # jobs submitted to this process
+        self.lock = threading.Lock()
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    def pending(self):
+        return sum(1 for job in self.jobs.values() if job['status'] in ('queued', 'running'))
+
+    def _path(self, job_id):
+        return os.path.join(self.folder, job_id + '.json')
+
+    def _save(self, job_id, job):
+        """Replaces the job's file atomically, readers never see a partly written one"""
+        if not self.folder:
+            return
+        path = self._path(job_id)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(job, f, ensure_ascii=False, default=lambda o: o.tolist())  # numpy scalars and arrays
+        os.replace(path + '.tmp', path)
+
+    def _load(self, job_id):
+        if not self.folder or not JOB_ID.fullmatch(job_id):
+            return None
+        try:
+            with open(self._path(job_id), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _expire(self):
+        now = time()
+        for job_id in [k for k, job in self.jobs.items() if job.get('finished', now) < now - self.ttl]:
+            del self.jobs[job_id]
+        if self.folder:
+            # files of jobs other processes ran; a job's file is last written when it finishes
+            for name in os.listdir(self.folder):
+                path = os.path.join(self.folder, name)
+                try:
+                    if name[:32] not in self.jobs and os.path.getmtime(path) < now - self.ttl:
+                        os.remove(path)
+                except OSError:
+                    pass  # removed by another process
+
+    def submit(self, fn, *args):
+        """Returns the id of the new job"""
+        with self.lock:
+            self._expire()
+            if self.pending() >= self.max_pending:
+                raise QueueFull()
+            job_id = uuid.uuid4().hex
+            job = self.jobs[job_id] = {'status': 'queued', 'created': time()}
+            self._save(job_id, job)
+        self.executor.submit(self._run, job_id, fn, *args)
+        return job_id
+
+    def _run(self, job_id, fn, *args):
+        job = self.jobs[job_id]
+        job['status'] = 'running'
+        job['started'] = time()
+        self._save(job_id, job)
+        try:
+            job['result'] = fn(*args)
+            job['status'] = 'done'
+        except Exception as e:
+            logging.exception('Job %s failed' % job_id)
+            job['error'] = str(e)
+            job['status'] = 'failed'
+        job['finished'] = time()
+        try:
+            self._save(job_id, job)
+        except (OSError, TypeError, ValueError) as e:
+            logging.exception('Could not save job %s' % job_id)
+            job.pop('result', None)
+            job['error'] = 'could not save the result: %s' % e
+            job['status'] = 'failed'
+            self._save(job_id, job)
+
+    def get(self, job_id):
+        """Job state: status, timestamps and either result or error; None for unknown or expired jobs"""
+        with self.lock:
+            self._expire()
+            job = self.jobs.get(job_id)
+        if job is None:
+            job = self._load(job_id)
+        if job is not None and job.get('finished', time()) < time() - self.ttl:
+            return None
+        return job
@@ -0,0 +1,90 @@
+"""
+Columnar document metadata: one memory-mapped array per field, indexed by document id.
+Strings are stored as fixed-width utf-8 bytes, fields with many repeated values are interned
+"""
+import json
+import logging
+import re
+
+import numpy as np
+
+from recommenders import storage
+
+FIELDS = ['case_num', 'case_id', 'doc_id', 'doc_name']
+
+
+def fixed_width(values):
+    encoded = [v.encode('utf-8') for v in values]
+    return np.array(encoded, dtype='S%d' % max([len(e) for e in encoded] + [1]))
+
+
+class MetadataStore:
+    """
+    `columns` maps a field to its fixed-width values, or to a (distinct values, codes) pair for interned fields
+    """
+    INTERN_RATIO = 0.5  # intern a field if it has fewer distinct values than this fraction of documents
+
+    def __init__(self, columns: dict):
+        self.columns = columns
+
+    @staticmethod
+    def build(rows):
+        """Store for a list of per-document dicts"""
+        columns = {}
+        for field in FIELDS:
+            values = [row.get(field) or '' for row in rows]
+            distinct = sorted(set(values))
+            if len(distinct) < MetadataStore.INTERN_RATIO * len(values):
+                codes = {v: i for i, v in enumerate(distinct)}
+                columns[field] = (fixed_width(distinct), np.array([codes[v] for v in values], dtype=np.int32))
+            else:
+                columns[field] = fixed_width(values)
+        return MetadataStore(columns)
+
+    @staticmethod
+    def from_json(meta_path, paths):
+        """Store for the documents at `paths`, looked up by case id in a json lines file of the crawler"""
+        with open(meta_path, 'r') as f:
+            meta_map = {}
+            for line in f:
+                doc_meta = json.loads(line)
+                meta_map[doc_meta['case_id']] = doc_meta
+        rows = [meta_map.get(re.search(r'([a-z0-9-]+)\.txt', p).group(1), {}) for p in paths]
+        missing = sum(1 for row in rows if not row)
+        if missing:
+            logging.warning('No metadata for %d documents' % missing)
+        return MetadataStore.build(rows)
+
+    def __len__(self):
+        column = self.columns[FIELDS[0]]
+        return len(column[1] if isinstance(column, tuple) else column)
+
+    def value(self, field, item):
+        column = self.columns[field]
+        if isinstance(column, tuple):
+            values, codes = column
+            return values[codes[item]].decode('utf-8')
+        return column[item].decode('utf-8')
+
+    def __getitem__(self, item):
+        if not 0 <= item < len(self):
+            raise IndexError(item)
+        return {field: self.value(field, item) for field in FIELDS}
+
+    def save(self, path):
+        arrays = {}
+        for field, column in self.columns.items():
+            if isinstance(column, tuple):
+                arrays[field + '_values'], arrays[field + '_codes'] = column
+            else:
+                arrays[field] = column
+        storage.save(path, type(self).__name__, arrays,
+                     {'interned': [f for f, c in self.columns.items() if isinstance(c, tuple)]})
+
+    @staticmethod
+    def load(path, mmap_mode='r'):
+        arrays, params = storage.load(path, MetadataStore.__name__, mmap_mode)
+        return MetadataStore({
+            field: (arrays[field + '_values'], arrays[field + '_codes']) if field in params['interned'] else arrays[field]
+            for field in FIELDS
+        })
@@ -0,0 +1,127 @@
+"""
+In-process metrics in the Prometheus text format, without a client library: histograms of stage latencies
+and counters, updated under a lock per metric, and values read from callbacks when they are rendered.
+Every web worker process keeps its own values, so each sample carries a `pid` label; sum over it to aggregate
+"""
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REGISTRY = []
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"')) for k, v in pairs)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def samples(self):
+        """(suffix, label values, extra labels, value) of every sample"""
+        raise NotImplementedError()
+
+    def render(self):
+        name = self.name + '_total' if self.kind == 'counter' else self.name
+        lines = ['# HELP %s %s' % (name, self.help), '# TYPE %s %s' % (name, self.kind)]
+        pid = [('pid', os.getpid())]  # read here, workers are forked after the metrics are created
+        for suffix, values, extra, value in self.samples():
+            lines.append('%s%s%s %s' % (name, suffix, format_labels(self.labels, values, list(extra) + pid),
+                                        repr(value)))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [('', key, (), value) for key, value in sorted(self.values.items())]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - t0, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = sorted((key, list(counts)) for key, counts in self.values.items())
+        samples = []
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', key, [('le', '+Inf' if bound == float('inf') else repr(bound))],
+                                cumulative))
+            samples.append(('_sum', key, (), counts[-1]))
+            samples.append(('_count', key, (), cumulative))
+        return samples
+
+
+class Callback(Metric):
+    """A gauge or counter whose values are read from `fn` when rendered: a number, or a dict by label value"""
+    def __init__(self, name, help, fn, kind='gauge', labels=()):
+        super().__init__(name, help, labels)
+        self.fn = fn
+        self.kind = kind
+
+    def samples(self):
+        value = self.fn()
+        if not isinstance(value, dict):
+            return [] if value is None else [('', (), (), value)]
+        return [('', key if isinstance(key, tuple) else (key,), (), v) for key, v in sorted(value.items())]
+
+
+def render():
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+STAGE_SECONDS = Histogram('recommender_stage_seconds', 'Time spent in a stage of the query pipeline',
+                          ['stage', 'model'])
+DOC_READS = Counter('recommender_doc_reads', 'Documents read from the document store', ['compressed'])
+DOC_READ_BYTES = Counter('recommender_doc_read_bytes', 'Bytes of documents read from the document store')
+BLOCK_READS = Counter('recommender_block_reads', 'Compressed blocks read and decompressed by the document store')
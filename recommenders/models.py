@@ -1,112 +1,336 @@
 import logging
 import os
 import pickle
-from collections import defaultdict
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from time import time
 
 import numpy as np
-from gensim import models, similarities, matutils
+from gensim import models, matutils, utils
 from gensim.models.doc2vec import TaggedDocument, Doc2Vec
 from nltk import SnowballStemmer
+from scipy.special import psi
 from sklearn.feature_extraction.text import TfidfVectorizer
 
+from recommenders import storage
+from recommenders.cache import ResultCache
+from recommenders.index import DenseIndex, unit_rows, restore_index, build_index, rebuild_index
+from recommenders.metrics import STAGE_SECONDS
+from recommenders.stems import StemCache, StemTable
+
 try:
     import artm
 except ImportError:
     logging.warn('ARTM module not available')
 
 
-class key_dependent_dict(defaultdict):
-    def __init__(self, f_of_x):
-        super().__init__(None)  # base class doesn't get a factory
-        self.f_of_x = f_of_x  # save f(x)
-
-    def __missing__(self, key):  # called when a default needed
-        ret = self.f_of_x(key)  # calculate default value
-        self[key] = ret  # and install it in the dict
-        return ret
-
-
 class Tokenizer:
     STOP_WORDS = {'от', 'на', 'не', 'рф', 'ст'}
+    CACHE_SIZE = 100000
     stemmer = SnowballStemmer("russian")
-    CACHE = key_dependent_dict(lambda w: Tokenizer.stemmer.stem(w))
+    CACHE = StemCache(stemmer.stem, CACHE_SIZE)
     analyzer = TfidfVectorizer().build_analyzer()
 
+    @staticmethod
+    def load_stems(path):
+        """Pre-populates the stem cache from a StemTable saved at `path`, if there is one"""
+        if os.path.exists(os.path.join(path, storage.MANIFEST)):
+            Tokenizer.CACHE = StemCache(Tokenizer.stemmer.stem, Tokenizer.CACHE_SIZE, StemTable.load(path))
+
+    @staticmethod
+    def analyze(doc: str):
+        return [w for w in Tokenizer.analyzer(doc) if w not in Tokenizer.STOP_WORDS]
+
     @staticmethod
     def tokenize(doc: str):
-        return [Tokenizer.CACHE[w] for w in Tokenizer.analyzer(doc) if w not in Tokenizer.STOP_WORDS]
+        return [Tokenizer.CACHE[w] for w in Tokenizer.analyze(doc)]
+
+    @staticmethod
+    def doc2bow(doc: str, dictionary):
+        table = Tokenizer.CACHE.table
+        if table is None or table.num_terms != len(dictionary):
+            return dictionary.doc2bow(Tokenizer.tokenize(doc))
+        return table.doc2bow(Tokenizer.analyze(doc), Tokenizer.CACHE.stem, dictionary)
 
 
 class ModelBase:
 
     N_BEST = 100
+    BATCH_SIZE = 256
 
-    def get_similar(self, doc, topn=10):
+    def project(self, docs) -> np.ndarray:
+        """Maps a list of documents into the index space, one row per document"""
         raise NotImplementedError()
 
+    def get_similar(self, doc, topn=10):
+        return self.get_similar_batch([doc], topn)[0]
+
+    def get_similar_batch(self, docs, topn=10):
+        """
+        Same as get_similar, but for a sequence of documents.
+        Each chunk of BATCH_SIZE queries is scored with a single matrix-matrix product
+        """
+        result = []
+        for ids, _ in self.search(docs, topn):
+            result.extend(ids.tolist())
+        return result
+
+    def get_similar_by_id(self, doc_id, topn=10):
+        """get_similar for a corpus document, using its stored vector instead of projecting it again"""
+        with STAGE_SECONDS.time(stage='index', model=type(self).__name__):
+            ids, _ = self.index.query(self.index.rows([doc_id]), min(topn, self.N_BEST))
+        return ids[0].tolist()
+
+    def search_indexed(self, topn=10):
+        """Same as search for every indexed document in order, from their stored vectors like get_similar_by_id"""
+        topn = min(topn, self.N_BEST)
+        name = type(self).__name__
+        for start in range(0, len(self.index), self.BATCH_SIZE):
+            with STAGE_SECONDS.time(stage='index', model=name):
+                rows = self.index.rows(np.arange(start, min(start + self.BATCH_SIZE, len(self.index))))
+                yield self.index.query(rows, topn)
+
+    def search(self, docs, topn=10):
+        """Yields (ids, similarities) arrays of the `topn` best matches for every chunk of `docs`"""
+        topn = min(topn, self.N_BEST)
+        name = type(self).__name__
+        for chunk in utils.chunkize_serial(docs, self.BATCH_SIZE):
+            with STAGE_SECONDS.time(stage='project', model=name):
+                vectors = self.project(chunk)
+            with STAGE_SECONDS.time(stage='index', model=name):
+                result = self.index.query(vectors, topn)
+            yield result
+
+    def add_documents(self, docs):
+        """Appends index rows for new documents, projected with the trained model as it is"""
+        for chunk in utils.chunkize_serial(docs, self.BATCH_SIZE):
+            self.index.append(self.project(chunk))
+
     def save(self, path):
-        with open(path, 'wb') as f:
-            pickle.dump(self, f)
+        storage.save(path, type(self).__name__, self._arrays(), self._params())
+
+    @classmethod
+    def load(cls, path, mmap_mode='r', **kwargs):
+        arrays, params = storage.load(path, cls.__name__, mmap_mode)
+        obj = cls.__new__(cls)
+        obj._restore(path, arrays, params, mmap_mode=mmap_mode, **kwargs)
+        return obj
 
     @staticmethod
-    def load(path, **kwargs):
+    def load_pickle(path, **kwargs):
+        """Loads a model pickled by an earlier version, so that it can be saved in the current format"""
         with open(path, 'rb') as f:
-            return pickle.load(f)
+            obj = pickle.load(f)
+        obj._upgrade(path, **kwargs)
+        return obj
+
+    def _arrays(self):
+        return self.index.arrays()
+
+    def _params(self):
+        return {'index': self.index.params()}
+
+    def _restore(self, path, arrays, params, **kwargs):
+        self.index = restore_index(arrays, params.get('index'))
+
+    def _upgrade(self, path, **kwargs):
+        # pickled models kept a gensim MatrixSimilarity, which stores unit-length rows as well
+        self.index = DenseIndex(self.index.index)
 
 
 class SimilarityIndex(ModelBase):
 
     def __init__(self, corpus, model, n_topics):
         self.model = model
+        self.n_topics = n_topics
 
         print('Building the index')
         t0 = time()
-        self.index = similarities.MatrixSimilarity(model[corpus], num_features=n_topics, num_best=self.N_BEST)
+        self.index = DenseIndex.from_corpus(model[corpus], n_topics)
         print("Index built in %.3fs" % (time() - t0))
 
-    def get_similar(self, doc, topn=10):
-        sims = self.index[self.model[doc]]
-        return [t[0] for t in sims[:topn]]
+    def project(self, docs):
+        return matutils.corpus2dense(self.model[docs], self.n_topics, len(docs)).T
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.model.save(os.path.join(path, 'model'))
+        super().save(path)
+
+    def _params(self):
+        return dict(super()._params(), n_topics=self.n_topics)
+
+    def _restore(self, path, arrays, params, mmap_mode=None, **kwargs):
+        super()._restore(path, arrays, params)
+        self.n_topics = params['n_topics']
+        self.model = utils.SaveLoad.load(os.path.join(path, 'model'), mmap=mmap_mode)
+
+    def _upgrade(self, path, **kwargs):
+        self.n_topics = self.index.num_features
+        super()._upgrade(path)
 
 
 class LsiModel(ModelBase):
 
-    def __init__(self, corpus, dictionary, n_topics):
+    LSI_FILE = 'lsi.model'
+
+    def __init__(self, corpus, dictionary, n_topics, shard_dir=None, shard_size=None):
         print('Building the index')
         t0 = time()
         self.lsi = models.LsiModel(corpus, id2word=dictionary, num_topics=n_topics, chunksize=40000)
+        self.lsi_file = None
+        self.projection = self.lsi.projection.u[:, :n_topics].astype(np.float32)
         print("LSI built in %.3fs" % (time() - t0))
 
-        self.index = similarities.MatrixSimilarity(self.lsi[corpus], num_features=n_topics, num_best=self.N_BEST)
+        self.index = build_index(self.lsi[corpus], n_topics, shard_dir, shard_size)
         print("LSI + index built in %.3fs" % (time() - t0))
 
-    def get_similar(self, doc, topn=10):
-        sims = self.index[self.lsi[doc]]
-        return [t[0] for t in sims[:topn]]
+    def project(self, docs):
+        # same as self.lsi[docs], but without the gensim model: bow * U
+        return matutils.corpus2csc(docs, self.projection.shape[0], dtype=np.float32).T @ self.projection
+
+    def truncated(self, n_topics):
+        """
+        The same model with only the first n_topics singular vectors. LSI of a smaller rank is a prefix
+        of the larger one, so the index is truncated and normalised again instead of retraining.
+        It can be queried and saved, but not updated: there is no gensim model of that rank
+        """
+        model = LsiModel.__new__(LsiModel)
+        model.lsi = None
+        model.lsi_file = None
+        model.projection = self.projection[:, :n_topics]
+        model.index = DenseIndex(unit_rows(self.index.index[:, :n_topics]))
+        return model
+
+    def add_documents(self, docs, corpus=None, shard_dir=None):
+        """
+        Updates the decomposition with new documents. This changes the projection of every document,
+        so the index is rebuilt from `corpus`, the whole corpus with the new documents at the end
+        """
+        if self.lsi is None:
+            if self.lsi_file is None or not os.path.exists(self.lsi_file):
+                raise ValueError("No gensim LSI model to update, truncated models can't be updated")
+            self.lsi = models.LsiModel.load(self.lsi_file)
+        t0 = time()
+        self.lsi.add_documents(docs)
+        self.projection = self.lsi.projection.u[:, :self.lsi.num_topics].astype(np.float32)
+        self.index = rebuild_index(self.index, self.lsi[corpus], self.lsi.num_topics, shard_dir)
+        print("LSI updated in %.3fs" % (time() - t0))
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        if self.lsi is not None:
+            self.lsi.save(os.path.join(path, self.LSI_FILE))
+        super().save(path)
+
+    def _arrays(self):
+        return dict(super()._arrays(), projection=self.projection)
+
+    def _restore(self, path, arrays, params, **kwargs):
+        super()._restore(path, arrays, params)
+        self.projection = arrays['projection']
+        self.lsi = None  # only needed for updates, loaded on demand
+        self.lsi_file = os.path.join(path, self.LSI_FILE)
+
+    def _upgrade(self, path, **kwargs):
+        super()._upgrade(path)
+        self.projection = self.lsi.projection.u[:, :self.lsi.num_topics].astype(np.float32)
+
+
+def dirichlet_expectation(alpha):
+    return psi(alpha) - psi(np.sum(alpha))
+
+
+def lda_inference(bow, exp_elogbeta, alpha, iterations=50, gamma_threshold=0.001):
+    """
+    Variational inference of the topic distribution of a single document, as in gensim's LdaModel.inference.
+    Gamma starts from a constant instead of a random draw, so results are deterministic
+    """
+    if not bow:
+        return np.full(len(alpha), 1.0 / len(alpha))
+    ids, cts = zip(*bow)
+    cts = np.asarray(cts, dtype=np.float64)
+    exp_elogbetad = exp_elogbeta[:, list(ids)]
+
+    gammad = np.ones(len(alpha))
+    exp_elogthetad = np.exp(dirichlet_expectation(gammad))
+    phinorm = exp_elogthetad @ exp_elogbetad + 1e-100
+    for _ in range(iterations):
+        lastgamma = gammad
+        gammad = alpha + exp_elogthetad * ((cts / phinorm) @ exp_elogbetad.T)
+        exp_elogthetad = np.exp(dirichlet_expectation(gammad))
+        phinorm = exp_elogthetad @ exp_elogbetad + 1e-100
+        if np.mean(np.abs(gammad - lastgamma)) < gamma_threshold:
+            break
+    return gammad / gammad.sum()
 
 
 class LdaModel(ModelBase):
 
-    def __init__(self, corpus, dictionary, n_topics):
+    MIN_PROBABILITY = 0.01
+
+    def __init__(self, corpus, dictionary, n_topics, shard_dir=None, shard_size=None):
         print('Building the index')
         t0 = time()
         self.lda = models.LdaModel(corpus, id2word=dictionary, num_topics=n_topics, chunksize=4000)
+        self.exp_elogbeta = self.lda.expElogbeta.astype(np.float32)
+        self.alpha = np.asarray(self.lda.alpha, dtype=np.float64)
         print("LDA built in %.3fs" % (time() - t0))
 
-        self.index = similarities.MatrixSimilarity(self.lda[corpus], num_features=n_topics, num_best=self.N_BEST)
+        self.index = build_index(self.lda[corpus], n_topics, shard_dir, shard_size)
         print("LDA + index built in %.3fs" % (time() - t0))
 
-    def get_similar(self, doc, topn=10):
-        sims = self.index[self.lda[doc]]
-        return [t[0] for t in sims[:topn]]
+    def project(self, docs):
+        theta = np.asarray([lda_inference(doc, self.exp_elogbeta, self.alpha) for doc in docs])
+        theta[theta < self.MIN_PROBABILITY] = 0  # gensim drops improbable topics as well
+        return theta
+
+    def _arrays(self):
+        return dict(super()._arrays(), exp_elogbeta=self.exp_elogbeta, alpha=self.alpha)
+
+    def _restore(self, path, arrays, params, **kwargs):
+        super()._restore(path, arrays, params)
+        self.exp_elogbeta = arrays['exp_elogbeta']
+        self.alpha = arrays['alpha']
+
+    def _upgrade(self, path, **kwargs):
+        super()._upgrade(path)
+        self.exp_elogbeta = self.lda.expElogbeta.astype(np.float32)
+        self.alpha = np.asarray(self.lda.alpha, dtype=np.float64)
+
+
+def artm_inference(bow, phi, passes=10):
+    """
+    Topic distribution of a single document as BigARTM's transform computes it without regularizers:
+    theta starts uniform and each pass is an EM step against the fixed word-topic matrix phi
+    """
+    n_topics = phi.shape[1]
+    theta = np.full(n_topics, 1.0 / n_topics)
+    if not bow:
+        return theta
+    ids, cts = zip(*bow)
+    phi_d = np.asarray(phi[list(ids)], dtype=np.float64)
+    cts = np.asarray(cts, dtype=np.float64)
+    known = phi_d.any(axis=1)  # words missing from the model's vocabulary are ignored
+    phi_d, cts = phi_d[known], cts[known]
+    if not len(cts):
+        return theta
+    for _ in range(passes):
+        n_t = theta * ((cts / (phi_d @ theta)) @ phi_d)
+        total = n_t.sum()
+        if total <= 0:
+            break
+        theta = n_t / total
+    return theta
 
 
 class BigArtmModel(ModelBase):
 
-    def __init__(self, uci_dir, dictionary, n_topics):
+    DOCUMENT_PASSES = 10  # BigARTM's default num_document_passes
+
+    def __init__(self, uci_dir, dictionary, n_topics, target_folder=None):
         bv = artm.BatchVectorizer(data_format='bow_uci', data_path=uci_dir, collection_name='corpus',
-                                  target_folder=uci_dir + '/artm_batches')
+                                  target_folder=target_folder or uci_dir + '/artm_batches')
         bv_dict = bv.dictionary
 
         logging.info("Fitting the ARTM model")
@@ -125,46 +349,97 @@ class BigArtmModel(ModelBase):
         logging.info("Building the index for ARTM")
         corpus = model.transform(bv).T.sort_index()
         corpus = [matutils.full2sparse(row) for index, row in corpus.iterrows()]
-        self.index = similarities.MatrixSimilarity(corpus, num_features=n_topics, num_best=self.N_BEST)
+        self.index = DenseIndex.from_corpus(corpus, n_topics)
 
         self.model = model
         self.dictionary = dictionary
 
+    def project(self, docs):
+        # NumPy EM against self.phi instead of the artm library's transform, which needs batches on disk
+        return np.asarray([artm_inference(doc, self.phi, self.DOCUMENT_PASSES) for doc in docs])
+
     def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        if self.model is not None:
+            self.model.save(os.path.join(path, 'model.artm'))
         super().save(path)
-        self.model.save(path+'.artm')
 
-    @staticmethod
-    def load(path, **kwargs):
-        with open(path, 'rb') as f:
-            obj = pickle.load(f)
-            obj.model = artm.ARTM(num_topics=10)
-            obj.model.load(path+'.artm')
-            return obj
+    def _arrays(self):
+        return dict(super()._arrays(), phi=self.phi)
 
-    def __getstate__(self):
-        d = self.__dict__.copy()
-        del d['model']
-        return d
+    def _restore(self, path, arrays, params, dictionary=None, **kwargs):
+        super()._restore(path, arrays, params)
+        self.phi = arrays['phi']
+        self.dictionary = dictionary
+        self.model = None  # serving only needs phi, the artm model file is kept for further training
 
-    def get_similar(self, doc, topn=10):
-        m = np.asarray([matutils.sparse2full(doc, len(self.dictionary))])
-        bv = artm.BatchVectorizer(data_format='bow_n_wd', n_wd=m.T, vocabulary=self.dictionary)
-        sims = self.index[matutils.full2sparse(self.model.transform(bv))]
-        return [t[0] for t in sims[:topn]]
+    def _upgrade(self, path, **kwargs):
+        super()._upgrade(path)
+        self.model = artm.ARTM(num_topics=10)
+        self.model.load(path + '.artm')
 
 
 class Doc2vecModel(ModelBase):
     """
-    NB: works with the raw corpus
+    NB: works with the raw corpus.
+    Corpus documents should be queried with get_similar_by_id, which uses their trained vectors
     """
+    INFER_WORKERS = os.cpu_count()
+
     def __init__(self, data_samples, n_topics, window=10):
         docs = [TaggedDocument(Tokenizer.tokenize(sample), [i]) for i, sample in enumerate(data_samples)]
         self.model = Doc2Vec(docs, vector_size=n_topics, window=window, min_count=10, workers=os.cpu_count())
         self.model.delete_temporary_training_data()
+        self.index = DenseIndex(unit_rows(self.model.docvecs.vectors_docs))
+        self.vector_cache = None
+        self._reset_executor()
+
+    def _reset_executor(self):
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        """Pool of INFER_WORKERS threads batches are inferred on, created by the first batch and then reused"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.INFER_WORKERS, thread_name_prefix='d2v-infer')
+            return self._executor
+
+    def cache_vectors(self, max_bytes):
+        """Keeps inferred vectors in an LRU cache keyed by a hash of the document"""
+        self.vector_cache = ResultCache(max_bytes, 'doc2vec') if max_bytes else None
+
+    def _infer(self, doc):
+        words = Tokenizer.tokenize(doc) if isinstance(doc, str) else doc
+        if self.vector_cache is None:
+            return self.model.infer_vector(words)
+        key = doc if isinstance(doc, str) else ' '.join(doc)
+        vector = self.vector_cache.get(key)
+        if vector is None:
+            vector = self.model.infer_vector(words)
+            self.vector_cache.put(key, vector)
+        return vector
+
+    def project(self, docs):
+        """Inferred vectors of texts or token lists, on INFER_WORKERS threads: gensim trains without the GIL"""
+        docs = list(docs)
+        if len(docs) == 1 or self.INFER_WORKERS == 1:
+            return np.asarray([self._infer(doc) for doc in docs])
+        return np.asarray(list(self.executor.map(self._infer, docs)))
 
-    def get_similar(self, doc, topn=10):
-        if isinstance(doc, str):
-            doc = Tokenizer.tokenize(doc)
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.model.save(os.path.join(path, 'doc2vec.model'))
+        super().save(path)
+
+    def _restore(self, path, arrays, params, mmap_mode=None, **kwargs):
+        super()._restore(path, arrays, params)
+        self.model = Doc2Vec.load(os.path.join(path, 'doc2vec.model'), mmap=mmap_mode)
+        self.vector_cache = None
+        self._reset_executor()
 
-        return [t[0] for t in self.model.docvecs.most_similar(positive=[self.model.infer_vector(doc)], topn=topn)]
+    def _upgrade(self, path, **kwargs):
+        self.index = DenseIndex(unit_rows(self.model.docvecs.vectors_docs))
+        self.vector_cache = None
+        self._reset_executor()
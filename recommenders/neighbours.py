@@ -0,0 +1,79 @@
+import logging
+from time import time
+
+import numpy as np
+
+from recommenders import storage
+
+
+class NeighbourTable:
+    """
+    Precomputed top-n recommendations of every corpus document for each model variant:
+    a docs x n int32 matrix of ids and a float16 matrix of similarities per variant.
+    Rows with fewer than n recommendations are padded with id -1
+    """
+    def __init__(self, ids: dict, scores: dict):
+        self.ids = ids
+        self.scores = scores
+
+    @staticmethod
+    def compute(variants: dict, n_docs, topn=20):
+        """
+        `variants` maps a variant name to a (model, corpus) pair, corpus being the model's input for every doc,
+        or None to query with the vectors the model has stored for them, as get_similar_by_id does
+        """
+        ids, scores = {}, {}
+        for name, (model, corpus) in variants.items():
+            logging.info("Computing neighbours for %s" % name)
+            t0 = time()
+            ids[name] = np.full((n_docs, topn), -1, dtype=np.int32)
+            scores[name] = np.zeros((n_docs, topn), dtype=np.float16)
+            pos = 0
+            results = model.search_indexed(topn) if corpus is None else model.search(corpus, topn)
+            for chunk_ids, chunk_sims in results:
+                ids[name][pos:pos + len(chunk_ids), :chunk_ids.shape[1]] = chunk_ids
+                scores[name][pos:pos + len(chunk_ids), :chunk_ids.shape[1]] = chunk_sims
+                pos += len(chunk_ids)
+            logging.info("%s: %d docs in %.3fs" % (name, pos, time() - t0))
+        return NeighbourTable(ids, scores)
+
+    def __len__(self):
+        return len(next(iter(self.ids.values())))
+
+    @property
+    def variants(self):
+        return set(self.ids)
+
+    def get(self, variant, doc_id, start=0, stop=None):
+        return [i for i in self.ids[variant][doc_id, start:stop].tolist() if i >= 0]
+
+    def save(self, path):
+        arrays = {}
+        for name in self.ids:
+            arrays[name + '_ids'] = self.ids[name]
+            arrays[name + '_scores'] = self.scores[name]
+        storage.save(path, type(self).__name__, arrays, {'variants': sorted(self.ids)})
+
+    @staticmethod
+    def load(path, mmap_mode='r'):
+        arrays, params = storage.load(path, NeighbourTable.__name__, mmap_mode)
+        return NeighbourTable({name: arrays[name + '_ids'] for name in params['variants']},
+                              {name: arrays[name + '_scores'] for name in params['variants']})
+
+
+if __name__ == '__main__':
+    import recommenders.webapp as webapp
+    import recommenders.webapp_config as conf
+    from recommenders.util import load_uci
+
+    corpus, data_samples, _, _ = load_uci(conf.DOCS_LOCATION)
+    corpus_tfidf = webapp.tfidf[corpus]
+
+    models = webapp.models
+    NeighbourTable.compute({
+        'lsi': (models.get('lsi'), corpus_tfidf),
+        'lda': (models.get('lda'), corpus_tfidf),
+        'd2v': (models.get('d2v'), None),  # trained vectors, like the live path for corpus documents
+        'artm': (models.get('artm'), corpus),
+        'artm_tfidf': (models.get('artm'), corpus_tfidf),
+    }, len(data_samples), conf.N_NEIGHBOURS).save(conf.NEIGHBOURS_PATH)
@@ -1,48 +1,110 @@
 import itertools
+import os
 import pickle
+import shutil
 import sys
+from multiprocessing import Pool
+from pathlib import Path
 from time import time
 
-from gensim.corpora import UciCorpus, Dictionary
+from gensim.corpora import Dictionary
 
+import recommenders.webapp_config as conf
+from recommenders.corpus import CsrCorpus
+from recommenders.docstore import DocStore, read_text
+from recommenders.metadata import MetadataStore
 from recommenders.models import Tokenizer
-from text_processing.simple import parse_all, cache_path
+from recommenders.vocab import Vocabulary
+from text_processing.simple import parse, cache_path
 
 
-def load_corpus(location, n_samples=None):
-    print("Loading the corpus...")
+def list_corpus(location, n_samples=None):
+    """Sources of the documents which have a preprocessed cache file. Texts are not loaded"""
+    print("Listing the corpus...")
     t0 = time()
-    data_samples = list(itertools.islice(parse_all(location, from_cache=True, with_paths=True), n_samples))
-    paths, data_samples = zip(*data_samples)
-    paths = [cache_path(p) for p in paths]
-    print("loaded %d samples in %0.3fs." % (len(data_samples), time() - t0))
-    return paths, data_samples
+    sources = (f for f in Path(location).rglob("*.html") if os.path.exists(cache_path(f)))
+    sources = list(itertools.islice(sources, n_samples))
+    print("found %d samples in %0.3fs." % (len(sources), time() - t0))
+    return sources
 
 
-def vectorize(corpus):
-    tokenized = [Tokenizer.tokenize(doc) for doc in corpus]
+def tokenize(source):
+    return Tokenizer.tokenize(parse(source, from_cache=True))
 
-    dictionary = Dictionary(tokenized)
+
+_dictionary = None
+
+
+def _set_dictionary(dictionary):
+    global _dictionary
+    _dictionary = dictionary
+
+
+def doc2bow(source):
+    return Tokenizer.doc2bow(parse(source, from_cache=True), _dictionary)
+
+
+def build_dictionary(sources, processes=None, chunksize=64):
+    """First pass: documents are tokenized on a process pool and added to the dictionary one at a time"""
+    t0 = time()
+    dictionary = Dictionary()
+    with Pool(processes) as pool:
+        for i, tokens in enumerate(pool.imap(tokenize, sources, chunksize), 1):
+            dictionary.add_documents([tokens])
+            if i % 10000 == 0:
+                print("dictionary: %d/%d docs, %.1f docs/sec" % (i, len(sources), i / (time() - t0)))
     dictionary.filter_extremes(no_below=10, no_above=0.66)
-    bows = [dictionary.doc2bow(doc) for doc in tokenized]
-    return dictionary, bows
+    print("built a dictionary of %d terms in %0.3fs." % (len(dictionary), time() - t0))
+    return dictionary
+
+
+def vectorize(sources, dictionary, processes=None, chunksize=64):
+    """Second pass: lazily yields bag-of-words of the documents, in order"""
+    with Pool(processes, initializer=_set_dictionary, initargs=(dictionary,)) as pool:
+        yield from pool.imap(doc2bow, sources, chunksize)
+
 
+def write_uci_bow(folder, corpus, dictionary):
+    """docword/vocab files of the bag-of-words in the UCI format, which BigArtmModel trains from"""
+    with open(os.path.join(folder, 'vocab.corpus.txt'), 'w') as f:
+        f.writelines(dictionary[i] + '\n' for i in range(len(dictionary)))
+    with open(os.path.join(folder, 'docword.corpus.txt'), 'w') as f:
+        f.write('%d\n%d\n%d\n' % (len(corpus), len(dictionary), len(corpus.data)))
+        for d, doc in enumerate(corpus):
+            f.writelines('%d %d %d\n' % (d + 1, w + 1, c) for w, c in doc)
+    # ARTM batches parsed from the previous files would be mixed with the new ones
+    for batches in Path(folder).glob('artm_batches*'):
+        shutil.rmtree(str(batches), ignore_errors=True)
 
-def save_uci(paths, corpus, dictionary, location):
-    UciCorpus.serialize(location, corpus, id2word=dictionary)
+
+def save_uci(paths, corpus, dictionary, location, block_size=0):
+    """
+    `corpus` may be a generator, it's written to disk as it's consumed. Texts at `paths` are packed into a DocStore,
+    and the UCI docword/vocab files for ARTM are written next to `location`
+    """
+    t0 = time()
+    corpus = CsrCorpus.write(location + '.csr', corpus, len(dictionary))
+    print("serialized the corpus in %0.3fs." % (time() - t0))
+    write_uci_bow(os.path.dirname(os.path.abspath(location)), corpus, dictionary)
+    print("wrote the UCI bag-of-words in %0.3fs." % (time() - t0))
+    DocStore.write(location + '.docs', (read_text(p) for p in paths), block_size)
+    print("packed the texts in %0.3fs." % (time() - t0))
+    if os.path.exists(location + '.meta.json'):
+        MetadataStore.from_json(location + '.meta.json', paths).save(location + '.meta')
     with open(location + '.docs.pickle', 'wb') as f:
         pickle.dump(paths, f)
 
     with open(location + '.dict.pickle', 'wb') as f:
         pickle.dump(dictionary, f)
+    Vocabulary.build(dictionary).save(location + '.vocab')
 
 
 if __name__ == '__main__':
     corpus_location = sys.argv[-2] if len(sys.argv) > 2 else '../out/docs_simple2'
     save_location = sys.argv[-1] if len(sys.argv) > 1 else '../out/corpus.uci'
 
-    paths, data_samples = load_corpus(corpus_location)
-    dictionary, docs = vectorize(data_samples)
-
-    save_uci(paths, docs, dictionary, save_location)
+    sources = list_corpus(corpus_location)
+    dictionary = build_dictionary(sources)
 
+    paths = [cache_path(s) for s in sources]
+    save_uci(paths, vectorize(sources, dictionary), dictionary, save_location, conf.DOCS_BLOCK_SIZE)
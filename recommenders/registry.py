@@ -0,0 +1,79 @@
+import logging
+import os
+import threading
+from time import time
+
+
+def resident_bytes():
+    """Resident set size of this process, None where /proc isn't available"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+class ModelRegistry:
+    """
+    Models loaded on first use, or ahead of it by a background prewarm thread. Every model loads at most once,
+    a model which fails to load is reported as failed and doesn't affect the others
+    """
+    def __init__(self):
+        self.loaders = {}
+        self.models = {}
+        self.state = {}
+        self.done = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, loader):
+        """`loader` is called without arguments and returns the model"""
+        self.loaders[name] = loader
+        self.state[name] = {'status': 'pending'}
+        self.done[name] = threading.Event()
+
+    def _load(self, name):
+        with self.lock:
+            if self.state[name]['status'] != 'pending':
+                return
+            self.state[name] = {'status': 'loading'}
+
+        rss, t0 = resident_bytes(), time()
+        try:
+            model = self.loaders[name]()
+        except Exception as e:
+            logging.exception('Loading %s failed' % name)
+            self.state[name] = {'status': 'failed', 'error': str(e), 'load_seconds': time() - t0}
+            self.done[name].set()
+            return
+        self.models[name] = model
+        after = resident_bytes()
+        # the RSS growth while loading, approximate if other models load at the same time
+        self.state[name] = {'status': 'ready', 'load_seconds': time() - t0,
+                            'resident_bytes': after - rss if rss is not None and after is not None else None}
+        self.done[name].set()
+        logging.info('Loaded %s in %.3fs' % (name, self.state[name]['load_seconds']))
+
+    def get(self, name, wait=True):
+        """
+        The model if it's loaded. Otherwise, with `wait` it is loaded in this thread (or waited for if it's loading);
+        without it the load is left to the prewarm thread and None is returned. None as well if the model failed
+        """
+        if name not in self.models and wait:
+            self._load(name)
+            self.done[name].wait()
+        return self.models.get(name)
+
+    def ready(self, name):
+        return name in self.models
+
+    def prewarm(self, names=None):
+        """Loads the models in order on a daemon thread, returns the thread"""
+        thread = threading.Thread(target=lambda: [self._load(name) for name in names or list(self.loaders)],
+                                  name='prewarm', daemon=True)
+        thread.start()
+        return thread
+
+    def health(self):
+        return {'models': {name: dict(state) for name, state in self.state.items()},
+                'ready': all(state['status'] == 'ready' for state in self.state.values()),
+                'resident_bytes': resident_bytes()}
@@ -0,0 +1,92 @@
+"""
+Shared-memory hosting of the read-only data the webapp serves from. The loader, `python -m recommenders.shm`,
+copies the model and corpus directories into SHM_DIR, a tmpfs such as /dev/shm, once before the workers start.
+Workers attach to the copies by memory-mapping them: every worker maps the same RAM-backed pages,
+so an extra worker costs its Python objects only and no page is ever read from disk
+"""
+import logging
+import os
+import shutil
+import sys
+from time import time
+
+import recommenders.webapp_config as conf
+
+# files which are only needed to train the models further, not to serve them
+UNSHARED = {'lsi.model', 'model.artm', 'recall.json', 'quantization.json'}
+
+
+def staged_path(path, root):
+    return os.path.join(root, os.path.basename(os.path.normpath(path)))
+
+
+def shared_files(path):
+    return sorted(name for name in os.listdir(path)
+                  if not any(name.startswith(u) for u in UNSHARED) and not name.endswith('.tmp'))
+
+
+def is_current(path, copy):
+    """Whether `copy` has the same files as `path`, with the same sizes and modification times"""
+    if not os.path.isdir(copy) or shared_files(path) != shared_files(copy):
+        return False
+    for name in shared_files(path):
+        src, dst = os.stat(os.path.join(path, name)), os.stat(os.path.join(copy, name))
+        if (src.st_size, src.st_mtime_ns) != (dst.st_size, dst.st_mtime_ns):
+            return False
+    return True
+
+
+def stage(path, root):
+    """Copies the directory at `path` into `root` unless an up to date copy is there, returns the size copied"""
+    target = staged_path(path, root)
+    if is_current(path, target):
+        return 0
+    os.makedirs(root, exist_ok=True)
+    shutil.rmtree(target + '.tmp', ignore_errors=True)
+    os.makedirs(target + '.tmp')
+    size = 0
+    for name in shared_files(path):
+        shutil.copy2(os.path.join(path, name), os.path.join(target + '.tmp', name))
+        size += os.path.getsize(os.path.join(path, name))
+
+    # workers which mapped the old copy keep their files, they are only unlinked
+    if os.path.exists(target):
+        os.replace(target, target + '.old')
+    os.replace(target + '.tmp', target)
+    shutil.rmtree(target + '.old', ignore_errors=True)
+    return size
+
+
+def attach(path, root=None):
+    """The shared copy of `path` if there is an up to date one in `root` (SHM_DIR by default), otherwise `path`"""
+    root = conf.SHM_DIR if root is None else root
+    if not root:
+        return path
+    copy = staged_path(path, root)
+    if not is_current(path, copy):
+        logging.warning('No up to date copy of %s in %s, mapping the original' % (path, root))
+        return path
+    return copy
+
+
+def serving_paths(location=conf.DOCS_LOCATION):
+    """Directories the webapp maps: corpus texts, metadata and vocabulary, stems, neighbours and the models"""
+    paths = [location + '.docs', location + '.meta', location + '.vocab', conf.STEMS_PATH, conf.NEIGHBOURS_PATH,
+             conf.LSI_PATH, conf.LDA_PATH, conf.ARTM_PATH, conf.D2V_PATH]
+    return [p for p in paths if os.path.isdir(p)]
+
+
+if __name__ == '__main__':
+    from recommenders.util import load_serving
+
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+    root = sys.argv[-1] if len(sys.argv) > 1 else conf.SHM_DIR
+    if not root:
+        sys.exit('Set SHM_DIR or pass the directory to copy to')
+
+    load_serving(conf.DOCS_LOCATION)  # builds the metadata store and the vocabulary of older corpora
+    t0 = time()
+    for path in serving_paths():
+        size = stage(path, root)
+        print("%s: %s" % (path, "copied %.1f MB" % (size / 2 ** 20) if size else "up to date"))
+    print("staged in %.3fs" % (time() - t0))
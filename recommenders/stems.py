@@ -0,0 +1,115 @@
+import hashlib
+from functools import lru_cache
+
+import numpy as np
+
+from recommenders import storage
+
+
+def word_hash(word: str):
+    return int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class StemTable:
+    """
+    Persistent surface form -> (stem, dictionary token id) table.
+    Forms are looked up by a 64-bit hash in a sorted array, all arrays are memory-mapped,
+    so the table is loaded instantly and shared between processes through the OS cache
+    """
+    def __init__(self, hashes, token_ids, stem_offsets, stem_data, num_terms):
+        self.hashes = hashes
+        self.token_ids = token_ids
+        self.stem_offsets = stem_offsets
+        self.stem_data = stem_data
+        self.num_terms = num_terms
+
+    @staticmethod
+    def build(words, stem, dictionary):
+        """Table for a set of surface forms. Token id is -1 for forms with a stem missing from the dictionary"""
+        by_hash = {}
+        for word in set(words):
+            h = word_hash(word)
+            by_hash[h] = None if h in by_hash else word  # forms with colliding hashes are left out
+
+        hashes = np.asarray(sorted(h for h, word in by_hash.items() if word is not None), dtype=np.uint64)
+        stems = [stem(by_hash[h]) for h in hashes.tolist()]
+        token_ids = np.asarray([dictionary.token2id.get(s, -1) for s in stems], dtype=np.int32)
+        encoded = [s.encode('utf-8') for s in stems]
+        stem_offsets = np.cumsum([0] + [len(s) for s in encoded]).astype(np.int64)
+        stem_data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return StemTable(hashes, token_ids, stem_offsets, stem_data, len(dictionary))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def find(self, words):
+        """Table positions of `words`, -1 for forms which are not in the table"""
+        hashes = np.fromiter((word_hash(w) for w in words), dtype=np.uint64, count=len(words))
+        if not len(self.hashes):
+            return np.full(len(words), -1)
+        pos = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+        return np.where(self.hashes[pos] == hashes, pos, -1)
+
+    def stem(self, word):
+        pos = self.find([word])[0]
+        if pos < 0:
+            return None
+        return bytes(self.stem_data[self.stem_offsets[pos]:self.stem_offsets[pos + 1]]).decode('utf-8')
+
+    def doc2bow(self, words, stem, dictionary):
+        """Same as dictionary.doc2bow([stem(w) for w in words]), without stemming forms present in the table"""
+        if not len(words):
+            return []
+        pos = self.find(words)
+        if not len(self.hashes):  # nothing to look up, token_ids[pos] would be out of bounds
+            ids = np.full(len(words), -1, dtype=np.int64)
+        else:
+            ids = np.where(pos >= 0, self.token_ids[pos], -1)
+        for i in np.flatnonzero(pos < 0):
+            ids[i] = dictionary.token2id.get(stem(words[i]), -1)
+        ids, counts = np.unique(ids[ids >= 0], return_counts=True)
+        return list(zip(ids.tolist(), counts.tolist()))
+
+    def save(self, path):
+        storage.save(path, type(self).__name__, {
+            'hashes': self.hashes, 'token_ids': self.token_ids,
+            'stem_offsets': self.stem_offsets, 'stem_data': self.stem_data,
+        }, {'num_terms': self.num_terms})
+
+    @staticmethod
+    def load(path, mmap_mode='r'):
+        arrays, params = storage.load(path, StemTable.__name__, mmap_mode)
+        return StemTable(arrays['hashes'], arrays['token_ids'], arrays['stem_offsets'], arrays['stem_data'],
+                         params['num_terms'])
+
+
+class StemCache:
+    """
+    Surface form -> stem mapping with a bounded LRU in front of an optional StemTable and the stemmer
+    """
+    def __init__(self, stem, maxsize=100000, table: StemTable = None):
+        self.table = table
+        self.stemmer = stem
+        self.stem = lru_cache(maxsize)(self._stem)
+
+    def _stem(self, word):
+        if self.table is not None:
+            stem = self.table.stem(word)
+            if stem is not None:
+                return stem
+        return self.stemmer(word)
+
+    def __getitem__(self, word):
+        return self.stem(word)
+
+
+if __name__ == '__main__':
+    import recommenders.webapp_config as conf
+    from recommenders.models import Tokenizer
+    from recommenders.util import load_uci
+
+    _, data_samples, dictionary, _ = load_uci(conf.DOCS_LOCATION)
+    words = set()
+    for doc in data_samples:
+        words.update(Tokenizer.analyze(doc))
+    StemTable.build(words, Tokenizer.stemmer.stem, dictionary).save(conf.STEMS_PATH)
@@ -0,0 +1,100 @@
+"""
+On-disk model layout: a directory with a manifest.json and one raw .npy file per array.
+Arrays are opened with mmap, so workers share pages through the OS cache
+"""
+import io
+import json
+import os
+import uuid
+
+import numpy as np
+
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+
+
+def mapped_file(array):
+    """Name of the file `array` is a memory map of, if it maps the whole file"""
+    if isinstance(array, np.memmap) and array.filename \
+            and array.offset + array.nbytes == os.path.getsize(array.filename):
+        return array.filename
+    return None
+
+
+def temp_name(target):
+    """A temporary file next to `target` of its own, processes saving the same file at once don't share it"""
+    return '%s.%s.tmp' % (target, uuid.uuid4().hex)
+
+
+def save_array(path, name, array):
+    target = os.path.join(path, name + '.npy')
+    if mapped_file(array) == os.path.abspath(target):
+        return  # the whole file is mapped, it's already stored in place
+    # Write to a temporary file and rename it, so processes that have the old file mapped keep a valid copy
+    tmp = temp_name(target)
+    with open(tmp, 'wb') as f:
+        np.save(f, np.ascontiguousarray(array))
+    os.replace(tmp, target)
+
+
+def append_rows(filename, rows: np.ndarray):
+    """
+    Appends rows to a C-ordered .npy file in place: the data goes to the end of the file and only the header is
+    rewritten. Returns the file mapped with the new shape, or None if the header can't be updated in place
+    """
+    with open(filename, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        if fortran_order or shape[1:] != rows.shape[1:]:
+            return None
+
+        header = io.BytesIO()
+        write_header = np.lib.format.write_array_header_1_0 if version == (1, 0) \
+            else np.lib.format.write_array_header_2_0
+        write_header(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+                              'shape': (shape[0] + len(rows),) + shape[1:]})
+        if len(header.getvalue()) != f.tell():
+            return None
+
+        # The header is updated last: until then readers see the old shape and ignore the new data
+        f.seek(0, os.SEEK_END)
+        f.write(np.ascontiguousarray(rows, dtype=dtype).tobytes())
+        f.flush()
+        f.seek(0)
+        f.write(header.getvalue())
+    return np.load(filename, mmap_mode='r')
+
+
+def save(path, kind, arrays: dict, params: dict = None):
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        save_array(path, name, array)
+
+    # The manifest is written last, so a partially written model can't be loaded
+    save_manifest(path, kind, arrays, params)
+
+
+def save_manifest(path, kind, names, params: dict = None):
+    """Lists arrays which are already stored in `path`"""
+    manifest = {'format': FORMAT_VERSION, 'class': kind, 'arrays': sorted(names), 'params': params or {}}
+    tmp = temp_name(os.path.join(path, MANIFEST))
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, os.path.join(path, MANIFEST))
+
+
+def load(path, kind, mmap_mode='r'):
+    manifest_path = os.path.join(path, MANIFEST)
+    if not os.path.exists(manifest_path):
+        raise FileNotFoundError(manifest_path)
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+
+    if manifest['format'] != FORMAT_VERSION:
+        raise ValueError('%s: unsupported format version %s' % (path, manifest['format']))
+    if manifest['class'] != kind:
+        raise ValueError('%s: expected %s, found %s' % (path, kind, manifest['class']))
+
+    arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in manifest['arrays']}
+    return arrays, manifest['params']
@@ -0,0 +1,160 @@
+"""
+Synthetic arbitration court judgments for benchmarks: raw texts shaped like the crawled ones (header, parties,
+"установил:", reasoning with sums, dates and code references, "решил:", operative part), each about one of
+a few dispute types with its own vocabulary, so that the models have topics to find.
+
+    python -m recommenders.synthetic <location> [n_docs] [seed]
+
+writes a corpus at <location> in the same layout as prepare_corpus
+"""
+import json
+import os
+import random
+import sys
+import uuid
+from time import time
+
+from gensim.corpora import Dictionary
+
+COURTS = ['Арбитражный суд города Москвы', 'Арбитражный суд Республики Татарстан',
+          'Арбитражный суд Свердловской области', 'Арбитражный суд города Санкт-Петербурга и Ленинградской области',
+          'Арбитражный суд Новосибирской области', 'Арбитражный суд Краснодарского края']
+ORG_FORMS = ['Общество с ограниченной ответственностью', 'Акционерное общество', 'Публичное акционерное общество',
+             'Закрытое акционерное общество', 'Открытое акционерное общество']
+ORG_NAMES = ['Ромашка', 'Стройинвест', 'Техснаб', 'Вектор', 'Альфа-Трейд', 'Северный ветер', 'Энергосервис',
+             'Гранит', 'Меридиан', 'Промресурс', 'Транслогистика', 'Агрокомплекс', 'Сибирь-Строй', 'Оникс']
+CODES = ['Гражданского кодекса Российской Федерации', 'Арбитражного процессуального кодекса Российской Федерации',
+         'Налогового кодекса Российской Федерации', 'Кодекса Российской Федерации об административных '
+                                                    'правонарушениях']
+MONTHS = ['января', 'февраля', 'марта', 'апреля', 'мая', 'июня', 'июля', 'августа', 'сентября', 'октября',
+          'ноября', 'декабря']
+
+# dispute type -> words specific to it, inflected forms included
+TOPICS = {
+    'supply': ['поставки', 'поставщик', 'покупатель', 'товар', 'товара', 'товарной', 'накладной', 'отгрузки',
+               'спецификации', 'партии', 'приемки', 'оплаты', 'поставленного', 'продукции', 'недопоставки'],
+    'lease': ['аренды', 'арендатор', 'арендодатель', 'арендной', 'платы', 'помещения', 'нежилого', 'имущества',
+              'пользование', 'передачи', 'акту', 'возврата', 'субаренды', 'площади', 'здания'],
+    'contract': ['подряда', 'подрядчик', 'заказчик', 'работ', 'выполненных', 'смете', 'строительства', 'объекта',
+                 'приемки', 'КС-2', 'КС-3', 'недостатков', 'гарантийного', 'удержания', 'сроков'],
+    'tax': ['налоговой', 'инспекции', 'налогоплательщика', 'проверки', 'решения', 'налога', 'добавленную',
+            'стоимость', 'вычета', 'доначисления', 'пени', 'штрафа', 'декларации', 'контрагента', 'выездной'],
+    'bankruptcy': ['должника', 'несостоятельным', 'банкротом', 'конкурсного', 'управляющего', 'кредиторов',
+                   'требований', 'реестр', 'наблюдения', 'процедуры', 'имущества', 'торгов', 'сделки',
+                   'оспаривании', 'собрания'],
+    'admin': ['административного', 'правонарушения', 'протокола', 'постановления', 'привлечении', 'ответственности',
+              'административный', 'орган', 'лицензии', 'проверки', 'нарушения', 'предписания', 'штрафа',
+              'состава', 'вины'],
+}
+COMMON = ['истец', 'ответчик', 'суд', 'договор', 'договора', 'обязательства', 'исковые', 'требования', 'сумме',
+          'основании', 'соответствии', 'материалами', 'дела', 'доказательства', 'представленные', 'сторон',
+          'надлежащим', 'образом', 'заявленные', 'указанные', 'обстоятельства', 'подтверждаются', 'отзыв',
+          'возражения', 'неустойки', 'процентов', 'пользование', 'чужими', 'денежными', 'средствами', 'претензию',
+          'задолженности', 'взыскании', 'удовлетворению', 'подлежат', 'частично', 'полностью', 'расходы']
+
+
+def org(rng):
+    return '%s «%s»' % (rng.choice(ORG_FORMS), rng.choice(ORG_NAMES))
+
+
+def date(rng):
+    if rng.random() < 0.5:
+        return '%02d.%02d.%d' % (rng.randint(1, 28), rng.randint(1, 12), rng.randint(2010, 2019))
+    return '%d %s %d года' % (rng.randint(1, 28), rng.choice(MONTHS), rng.randint(2010, 2019))
+
+
+def amount(rng):
+    rubles = rng.randint(1000, 50000000)
+    return '%s руб. %02d коп.' % ('{:,}'.format(rubles).replace(',', ' '), rng.randint(0, 99))
+
+
+def sentence(rng, words):
+    parts = [rng.choice(words) for _ in range(rng.randint(8, 20))]
+    extra = rng.random()
+    if extra < 0.2:
+        parts.append('в размере ' + amount(rng))
+    elif extra < 0.35:
+        parts.append('от ' + date(rng))
+    elif extra < 0.5:
+        parts.append('согласно статье %d %s' % (rng.randint(1, 1200), rng.choice(CODES)))
+    elif extra < 0.6:
+        parts.append(org(rng))
+    text = ' '.join(parts)
+    return text[0].upper() + text[1:] + ('' if text.endswith('.') else '.')
+
+
+def document(rng, topic, n_words=600):
+    """Raw text of one judgment about `topic`, about `n_words` words long"""
+    words = TOPICS[topic] * 3 + COMMON  # topic words are more likely than common ones
+    plaintiff, defendant = org(rng), org(rng)
+    case_num = 'А%02d-%d/%d' % (rng.randint(10, 80), rng.randint(1, 99999), rng.randint(2010, 2019))
+    body = []
+    while sum(len(s.split()) for s in body) < n_words:
+        body.append(sentence(rng, words))
+    paragraphs = ['\n'.join(body[i:i + 4]) for i in range(0, len(body), 4)]
+    return '\n'.join([
+        rng.choice(COURTS),
+        'Именем Российской Федерации',
+        'Р Е Ш Е Н И Е',
+        'г. Москва %s Дело № %s' % (date(rng), case_num),
+        'Резолютивная часть решения объявлена %s' % date(rng),
+        'по иску %s к %s' % (plaintiff, defendant),
+        'о взыскании %s' % amount(rng),
+        'при участии: от истца – представитель по доверенности, от ответчика – не явился',
+        'установил:',
+    ] + paragraphs + [
+        'Руководствуясь статьями 110, 167-170, 176 Арбитражного процессуального кодекса Российской Федерации, суд',
+        'решил:',
+        'Взыскать с %s в пользу %s %s долга, а также расходы по уплате государственной пошлины в размере %s.' % (
+            defendant, plaintiff, amount(rng), amount(rng)),
+        'Решение может быть обжаловано в течение месяца.',
+    ]) + '\n'
+
+
+def generate(n_docs, seed=0, n_words=(300, 1500)):
+    """Yields (case id, topic, raw text) of `n_docs` documents, the same ones for the same seed"""
+    rng = random.Random(seed)
+    topics = sorted(TOPICS)
+    for _ in range(n_docs):
+        topic = rng.choice(topics)
+        yield str(uuid.UUID(int=rng.getrandbits(128))), topic, document(rng, topic, rng.randint(*n_words))
+
+
+def write_corpus(location, n_docs, seed=0, block_size=0):
+    """
+    Preprocesses synthetic documents and saves them at `location` like prepare_corpus does,
+    with the texts in <location>.texts and crawler-style metadata. Returns the topic of every document
+    """
+    from recommenders.models import Tokenizer
+    from recommenders.prepare_corpus import save_uci
+    from text_processing.base import preprocess
+
+    os.makedirs(location + '.texts', exist_ok=True)
+    paths, texts, topics = [], [], []
+    with open(location + '.meta.json', 'w') as meta:
+        for case_id, topic, raw in generate(n_docs, seed):
+            path = os.path.join(location + '.texts', case_id + '.txt')
+            text = preprocess(raw)
+            with open(path, 'w') as f:
+                f.write(text)
+            meta.write(json.dumps({'case_id': case_id, 'case_num': 'А40-%d/2018' % len(paths), 'doc_id': case_id,
+                                   'doc_name': 'A40-%d-2018_%s.pdf' % (len(paths), topic)},
+                                  ensure_ascii=False) + '\n')
+            paths.append(path)
+            texts.append(text)
+            topics.append(topic)
+
+    tokens = [Tokenizer.tokenize(text) for text in texts]
+    dictionary = Dictionary(tokens)
+    dictionary.filter_extremes(no_below=2, no_above=0.9)
+    save_uci(paths, (dictionary.doc2bow(t) for t in tokens), dictionary, location, block_size)
+    return topics
+
+
+if __name__ == '__main__':
+    location = sys.argv[1]
+    n_docs = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    t0 = time()
+    write_corpus(location, n_docs, seed)
+    print("wrote %d documents in %.3fs" % (n_docs, time() - t0))
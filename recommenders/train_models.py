@@ -1,12 +1,16 @@
+import json
 import logging
+import os
 import pickle
 import sys
 
-from gensim.models import TfidfModel
+import numpy as np
 
 import recommenders.webapp_config as conf
-from recommenders.models import LsiModel, LdaModel, Doc2vecModel, BigArtmModel
-from recommenders.util import load_uci
+from recommenders.corpus import Tfidf
+from recommenders.index import DenseIndex, IvfIndex, QuantizedIndex, recall_report, quantization_report
+from recommenders.models import LsiModel, LdaModel, Doc2vecModel, BigArtmModel, Tokenizer
+from recommenders.util import load_uci, load
 
 
 def save(model, path):
@@ -14,28 +18,105 @@ def save(model, path):
         pickle.dump(model, f)
 
 
+def exact_index(index):
+    """DenseIndex with the rows of any index, in document order"""
+    if isinstance(index, IvfIndex):
+        return DenseIndex(index.index[np.argsort(index.ids)])
+    if isinstance(index, QuantizedIndex):
+        return DenseIndex(np.asarray(index.rows(np.arange(len(index)))))
+    return DenseIndex(np.asarray(index.index))
+
+
+def sample_queries(index, n_queries):
+    return index.index[np.random.RandomState(0).choice(len(index), min(n_queries, len(index)), replace=False)]
+
+
+def build_ann(cls, path, n_queries=1000, **kwargs):
+    """Replaces the exact index of a saved model with an IvfIndex and writes a recall report next to it"""
+    model = cls.load(path, mmap_mode=None, **kwargs)
+    exact = exact_index(model.index)
+
+    logging.info("Building the approximate index for %s" % path)
+    model.index = IvfIndex.build(exact.index, conf.ANN_LISTS, conf.ANN_PROBE)
+
+    report = recall_report(exact, model.index, sample_queries(exact, n_queries), topn=20)
+    for row in report:
+        logging.info("n_probe=%(n_probe)s: recall@20 %(recall).3f, %(ms_per_query).2f ms/query" % row)
+
+    model.save(path)
+    with open(os.path.join(path, 'recall.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def build_quantized(cls, path, n_queries=1000, **kwargs):
+    """
+    Replaces the index of a saved model with a QuantizedIndex, keeping the float32 rows for reranking,
+    and writes a report of memory against top-20 overlap for float16 and int8 next to it
+    """
+    model = cls.load(path, mmap_mode=None, **kwargs)
+    exact = exact_index(model.index)
+
+    report = quantization_report(exact, sample_queries(exact, n_queries), topn=20,
+                                 reranks=sorted({0, conf.QUANT_RERANK}))
+    for row in report:
+        logging.info("%(dtype)s, rerank=%(rerank)s: %(bytes)d bytes, overlap@20 %(overlap).3f, "
+                     "%(ms_per_query).2f ms/query" % row)
+
+    logging.info("Quantizing the index for %s to %s" % (path, conf.INDEX_QUANTIZATION))
+    model.index = QuantizedIndex.build(exact.index, conf.INDEX_QUANTIZATION, conf.QUANT_RERANK)
+    model.save(path)
+    with open(os.path.join(path, 'quantization.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+
 if __name__ == '__main__':
     lsi_on = '--lsi' in sys.argv
     lda_on = '--lda' in sys.argv
     d2v_on = '--d2v' in sys.argv
     artm_on = '--artm' in sys.argv
+    convert = '--convert' in sys.argv
+    ann = '--ann' in sys.argv
+    quantize = '--quantize' in sys.argv
 
     logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 
+    if convert:
+        # Re-save pickled models in the current format instead of training new ones
+        for cls, src, dst, on in [(LsiModel, conf.LSI_PICKLE, conf.LSI_PATH, lsi_on),
+                                  (LdaModel, conf.LDA_PICKLE, conf.LDA_PATH, lda_on),
+                                  (Doc2vecModel, conf.D2V_PICKLE, conf.D2V_PATH, d2v_on),
+                                  (BigArtmModel, conf.ARTM_PICKLE, conf.ARTM_PATH, artm_on)]:
+            if on:
+                cls.load_pickle(src).save(dst)
+        sys.exit()
+
+    if ann or quantize:
+        dictionary = load(conf.DOCS_LOCATION + '.dict.pickle')
+        for cls, path, on in [(LsiModel, conf.LSI_PATH, lsi_on), (LdaModel, conf.LDA_PATH, lda_on),
+                              (Doc2vecModel, conf.D2V_PATH, d2v_on), (BigArtmModel, conf.ARTM_PATH, artm_on)]:
+            if on:
+                (build_ann if ann else build_quantized)(cls, path, dictionary=dictionary)
+        sys.exit()
+
     corpus, data_samples, dictionary, _ = load_uci(conf.DOCS_LOCATION)
 
     if lsi_on or lda_on:
-        tfidf = TfidfModel(dictionary=dictionary, smartirs='ntc')
-        corpus = [tfidf[doc] for doc in corpus]
+        tfidf = Tfidf(dictionary)
+        if conf.INDEX_SHARD_SIZE:
+            # stream the corpus from disk instead of keeping it in memory
+            corpus = tfidf.write(corpus, conf.DOCS_LOCATION + '.tfidf.csr')
+        else:
+            corpus = tfidf[corpus]
 
     if lsi_on:
-        LsiModel(corpus, dictionary, conf.N_TOPICS).save(conf.LSI_PICKLE)
+        LsiModel(corpus, dictionary, conf.N_TOPICS, conf.LSI_PATH, conf.INDEX_SHARD_SIZE).save(conf.LSI_PATH)
 
     if lda_on:
-        LdaModel(corpus, dictionary, conf.N_TOPICS).save(conf.LDA_PICKLE)
+        LdaModel(corpus, dictionary, conf.N_TOPICS, conf.LDA_PATH, conf.INDEX_SHARD_SIZE).save(conf.LDA_PATH)
 
     if d2v_on:
-        Doc2vecModel(data_samples, conf.N_TOPICS).save(conf.D2V_PICKLE)
+        Tokenizer.load_stems(conf.STEMS_PATH)
+        Doc2vecModel(data_samples, conf.N_TOPICS).save(conf.D2V_PATH)
 
     if artm_on:
-        BigArtmModel(conf.UCI_FOLDER, dictionary, conf.N_TOPICS).save(conf.ARTM_PICKLE)
+        BigArtmModel(conf.UCI_FOLDER, dictionary, conf.N_TOPICS).save(conf.ARTM_PATH)
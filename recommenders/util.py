@@ -1,32 +1,42 @@
-import json
 import os
 import pickle
-import re
 from time import time
 
-from gensim.corpora import UciCorpus
-
+from recommenders import storage
+from recommenders.corpus import CsrCorpus
+from recommenders.docstore import DocStore
+from recommenders.metadata import MetadataStore
 from recommenders.models import Tokenizer
+from recommenders.vocab import Vocabulary
 
 
-class RandomAccessCorpus:
-    """
-    Enables random access for a filesystem-based corpus
-    """
-    def __init__(self, paths):
-        self.paths = paths
-        self.len = len(paths)
+def load_vocabulary(location):
+    """Vocabulary of the corpus at `location`, built from its dictionary if the corpus predates it"""
+    if not os.path.exists(os.path.join(location + '.vocab', storage.MANIFEST)):
+        Vocabulary.build(load(location + '.dict.pickle')).save(location + '.vocab')
+    return Vocabulary.load(location + '.vocab')
 
-    def __len__(self):
-        return len(self.paths)
 
-    def __getitem__(self, item):
-        with open(self.paths[item], 'r') as f:
-            return ''.join(f)
+def load_metadata(location, paths=None):
+    if not os.path.exists(os.path.join(location + '.meta', storage.MANIFEST)):
+        # corpus prepared by an earlier version, the metadata store is built once
+        paths = load(location + '.docs.pickle') if paths is None else paths
+        MetadataStore.from_json(location + '.meta.json', paths).save(location + '.meta')
+    return MetadataStore.load(location + '.meta')
 
-    def __iter__(self):
-        for i in range(self.len):
-            yield self[i]
+
+def load_serving(location, attach=None):
+    """
+    What the webapp needs of the corpus: texts, vocabulary and metadata, but not the bag-of-words.
+    `attach` maps each directory to the one to load it from, see recommenders.shm
+    """
+    attach = attach or (lambda path: path)
+    # for an older corpus every worker may build these at once: each saves through its own temporary files,
+    # the stores come out the same. The shm loader builds them before the workers start
+    load_vocabulary(location)
+    load_metadata(location)
+    return (DocStore.load(attach(location + '.docs')), Vocabulary.load(attach(location + '.vocab')),
+            MetadataStore.load(attach(location + '.meta')))
 
 
 def load_uci(location):
@@ -36,23 +46,17 @@ def load_uci(location):
     paths = load(location + '.docs.pickle')
 
     dictionary = load(location + '.dict.pickle')
+    metadata = load_metadata(location, paths)
 
-    with open(location + '.meta.json', 'r') as f_meta:
-        meta_map = {}
-        for line in f_meta:
-            doc_meta = json.loads(line)
-            meta_map[doc_meta['case_id']] = doc_meta
-        metadata = [meta_map[re.search(r'([a-z0-9-]+)\.txt', p).group(1)] for p in paths]
-
-    data_samples = RandomAccessCorpus(paths)
-    corpus = UciCorpus(location)
+    data_samples = DocStore.load(location + '.docs')
+    corpus = CsrCorpus.load(location + '.csr')
     print("loaded %d samples in %0.3fs." % (len(corpus), time() - t0))
 
     return corpus, data_samples, dictionary, metadata
 
 
 def tokenize(text, dictionary):
-    return dictionary.doc2bow(Tokenizer.tokenize(text))
+    return Tokenizer.doc2bow(text, dictionary)
 
 
 def load(pickle_path):
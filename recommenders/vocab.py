@@ -0,0 +1,77 @@
+"""
+Read-only replacement of the gensim Dictionary for serving: token ids and document frequencies in memory-mapped
+arrays instead of Python dicts, so that worker processes share them instead of unpickling a copy each
+"""
+import sys
+from time import time
+
+import numpy as np
+
+from recommenders import storage
+from recommenders.stems import word_hash
+
+
+class Vocabulary:
+    """
+    Token -> id lookup by a 64-bit hash in a sorted array, with the document frequencies of the dictionary.
+    Supports the parts of the Dictionary interface used at query time: len, token2id.get, doc2bow, dfs, num_docs
+    """
+    def __init__(self, hashes, ids, dfs, num_docs):
+        self.hashes = hashes
+        self.ids = ids
+        self.dfs = dfs
+        self.num_docs = num_docs
+
+    @staticmethod
+    def build(dictionary):
+        hashes = np.fromiter((word_hash(t) for t in dictionary.token2id), dtype=np.uint64, count=len(dictionary))
+        ids = np.fromiter(dictionary.token2id.values(), dtype=np.int32, count=len(dictionary))
+        order = np.argsort(hashes)
+        dfs = np.zeros(len(dictionary), dtype=np.int64)
+        dfs[list(dictionary.dfs)] = list(dictionary.dfs.values())
+        return Vocabulary(hashes[order], ids[order], dfs, dictionary.num_docs)
+
+    def __len__(self):
+        return len(self.dfs)
+
+    @property
+    def token2id(self):
+        return self
+
+    def lookup(self, tokens):
+        """Ids of tokens, -1 for unknown ones"""
+        hashes = np.fromiter((word_hash(t) for t in tokens), dtype=np.uint64, count=len(tokens))
+        if not len(self.hashes):
+            return np.full(len(tokens), -1)
+        pos = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+        return np.where(self.hashes[pos] == hashes, self.ids[pos], -1)
+
+    def get(self, token, default=None):
+        token_id = int(self.lookup([token])[0])
+        return default if token_id < 0 else token_id
+
+    def doc2bow(self, tokens):
+        ids = self.lookup(list(tokens))
+        ids, counts = np.unique(ids[ids >= 0], return_counts=True)
+        return list(zip(ids.tolist(), counts.tolist()))
+
+    def save(self, path):
+        storage.save(path, type(self).__name__, {'hashes': self.hashes, 'ids': self.ids, 'dfs': self.dfs},
+                     {'num_docs': self.num_docs})
+
+    @staticmethod
+    def load(path, mmap_mode='r'):
+        arrays, params = storage.load(path, Vocabulary.__name__, mmap_mode)
+        return Vocabulary(arrays['hashes'], arrays['ids'], arrays['dfs'], params['num_docs'])
+
+
+if __name__ == '__main__':
+    # builds the vocabulary of an existing corpus
+    import recommenders.webapp_config as conf
+    from recommenders.util import load
+
+    location = sys.argv[-1] if len(sys.argv) > 1 else conf.DOCS_LOCATION
+    t0 = time()
+    vocabulary = Vocabulary.build(load(location + '.dict.pickle'))
+    vocabulary.save(location + '.vocab')
+    print("saved %d terms in %.3fs" % (len(vocabulary), time() - t0))
@@ -1,65 +1,179 @@
+import atexit
 import logging
+import os
 import random
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from time import time
 
-from flask import Flask, render_template, request
+from flask import Flask, g, jsonify, render_template, request, redirect, url_for
 from flask_migrate import Migrate
 from flask_restful import Api, Resource
 from flask_sqlalchemy import SQLAlchemy
-from gensim.models import TfidfModel
 from tika import unpack
 
-from recommenders.models import LsiModel, LdaModel, BigArtmModel, Doc2vecModel
-from recommenders.util import load_uci, tokenize, kad_pdf_path
+from recommenders import shm, storage
+from recommenders.cache import ResultCache
+from recommenders.corpus import Tfidf
+from recommenders.index import IvfIndex
+from recommenders.jobs import JobQueue, QueueFull
+from recommenders.metrics import STAGE_SECONDS, Callback, Counter, Histogram, render as render_metrics
+from recommenders.models import LsiModel, LdaModel, BigArtmModel, Doc2vecModel, Tokenizer
+from recommenders.neighbours import NeighbourTable
+from recommenders.registry import ModelRegistry
+from recommenders.util import load_serving, tokenize, kad_pdf_path
 from text_processing.base import preprocess
 
 
 def doc_for_api(doc_id):
+    meta = metadata[doc_id]
     return {
         'id': int(doc_id),
         'url': api.url_for(DocResource, doc_id=doc_id, _external=True),
-        'case_number': metadata[doc_id]['case_num'],
-        'pdf_path': kad_pdf_path(metadata[doc_id]),
+        'case_number': meta['case_num'],
+        'pdf_path': kad_pdf_path(meta),
     }
 
 
-def get_similar(data_sample, idx_to_doc=lambda x: x, cut_first=False):
-    bow = tokenize(data_sample, dictionary)
-    vec_tfidf = tfidf[bow]
-
-    start_idx = 1 if cut_first else 0
-    return {
-        'lsi': [idx_to_doc(sim) for sim in lsi.get_similar(vec_tfidf)[start_idx:]],
-        'lda': [idx_to_doc(sim) for sim in lda.get_similar(vec_tfidf)[start_idx:]],
-        'd2v': [idx_to_doc(sim) for sim in d2v.get_similar(data_sample)[start_idx:]],
-        'artm': [idx_to_doc(sim) for sim in artm.get_similar(bow)[start_idx:]],
-        'artm_tfidf': [idx_to_doc(sim) for sim in artm.get_similar(vec_tfidf)[start_idx:]],
+def query_models(data_sample, doc_id=None):
+    """
+    Queries all models concurrently, each on its own pool. Models that aren't loaded yet, have MODEL_MAX_INFLIGHT
+    queries in flight already or miss their deadline (MODEL_DEADLINES) get an empty list and are reported
+    under 'missing'.
+    Doc2vec uses the trained vector of a corpus document (doc_id) instead of inferring it
+    """
+    with STAGE_SECONDS.time(stage='tokenize'):
+        bow = tokenize(data_sample, dictionary)
+    with STAGE_SECONDS.time(stage='tfidf'):
+        vec_tfidf = tfidf[bow]
+    loaded = {name: models.get(name, wait=not app.config['MODEL_PREWARM']) for name in MODELS}
+    queries = {
+        'lsi': ('lsi', vec_tfidf),
+        'lda': ('lda', vec_tfidf),
+        'd2v': ('d2v', data_sample),
+        'artm': ('artm', bow),
+        'artm_tfidf': ('artm', vec_tfidf),
     }
 
+    t0 = time()
+    result = {'missing': []}
+    futures = {}
+    for variant, (name, query) in queries.items():
+        model = loaded[name]
+        if model is None:
+            result[variant] = []
+            result['missing'].append(variant)
+        elif not inflight[name].acquire(blocking=False):
+            logging.warning('%s is skipped, too many queries in flight' % variant)
+            OVERLOAD_SKIPS.inc(variant=variant)
+            result[variant] = []
+            result['missing'].append(variant)
+        else:
+            if variant == 'd2v' and doc_id is not None:
+                futures[variant] = executors[name].submit(model.get_similar_by_id, doc_id)
+            else:
+                futures[variant] = executors[name].submit(model.get_similar, query)
+            futures[variant].add_done_callback(lambda _, slots=inflight[name]: slots.release())
+
+    for variant, future in futures.items():
+        try:
+            result[variant] = future.result(timeout=max(0, t0 + app.config['MODEL_DEADLINES'][variant] - time()))
+        except TimeoutError:
+            future.cancel()
+            logging.warning('%s missed its deadline' % variant)
+            DEADLINE_MISSES.inc(variant=variant)
+            result[variant] = []
+            result['missing'].append(variant)
+    return result
+
+
+def get_similar(data_sample, idx_to_doc=lambda x: x, cut_first=False, doc_id=None):
+    """query_models for a preprocessed text, served from the result cache if it has been queried before"""
+    similar = results.get(data_sample, doc_id)
+    if similar is None:
+        similar = query_models(data_sample, doc_id)
+        if not similar['missing']:  # partial results are not cached
+            results.put(data_sample, similar, doc_id)
+    return map_similar(similar, idx_to_doc, 1 if cut_first else 0)
+
+
+def get_similar_for_doc(doc_id, idx_to_doc=lambda x: x, topn=10):
+    """Same as get_similar for a corpus document, but read from the precomputed table if there is one"""
+    if neighbours is None:
+        return get_similar(data_samples[doc_id], idx_to_doc, True, doc_id)
+    result = {variant: [idx_to_doc(sim) for sim in neighbours.get(variant, doc_id, 1, topn)] for variant in VARIANTS}
+    result['missing'] = []
+    return result
+
+
+def map_similar(similar, idx_to_doc, start_idx=0):
+    return {variant: ids if variant == 'missing' else [idx_to_doc(sim) for sim in ids[start_idx:]]
+            for variant, ids in similar.items()}
+
+
+def process_upload(path):
+    """Extracts the text of an uploaded file and finds similar documents, runs on the upload queue"""
+    try:
+        with STAGE_SECONDS.time(stage='tika'):
+            content = unpack.from_file(path)['content']
+    finally:
+        os.remove(path)
+    with STAGE_SECONDS.time(stage='preprocess'):
+        text = preprocess(content)
+    return {'text': text, 'similar': get_similar(text)}
+
+
+def submit_upload(file):
+    """Spools the upload to a temporary file and queues it. Returns the job id, raises QueueFull under load"""
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as f:
+        file.save(f)
+    try:
+        return uploads.submit(process_upload, path)
+    except QueueFull:
+        os.remove(path)
+        raise
+
 
 class UploadResource(Resource):
     def post(self):
-        file = request.files['file']
-
-        tmp_file = tempfile.NamedTemporaryFile()
-        file.save(tmp_file)
-        text = preprocess(unpack.from_file(tmp_file.name)['content'])
-        tmp_file.close()
+        try:
+            job_id = submit_upload(request.files['file'])
+        except QueueFull:
+            return {'message': 'Too many uploads in progress, try again later'}, 503, {'Retry-After': '10'}
 
         return {
-            'text': text,
-            'similar': get_similar(text, doc_for_api)
-        }
+            'job_id': job_id,
+            'status': 'queued',
+            'url': api.url_for(UploadJobResource, job_id=job_id, _external=True),
+        }, 202
+
+
+class UploadJobResource(Resource):
+    def get(self, job_id):
+        job = uploads.get(job_id)
+        if job is None:
+            return {'message': 'Unknown job'}, 404
+
+        response = {'job_id': job_id, 'status': job['status']}
+        if job['status'] == 'done':
+            response['text'] = job['result']['text']
+            response['similar'] = map_similar(job['result']['similar'], doc_for_api)
+        elif job['status'] == 'failed':
+            response['error'] = job['error']
+        return response
 
 
 class DocResource(Resource):
     def get(self, doc_id):
+        meta = metadata[doc_id]
         return {
             'id': doc_id,
-            'case_number': metadata[doc_id]['case_num'],
-            'pdf_path': kad_pdf_path(metadata[doc_id]),
+            'case_number': meta['case_num'],
+            'pdf_path': kad_pdf_path(meta),
             'text': data_samples[doc_id],
-            'similar': get_similar(data_samples[doc_id], doc_for_api, True),
+            'similar': get_similar_for_doc(doc_id, doc_for_api),
         }
 
 
@@ -74,19 +188,119 @@ migrate = Migrate(app, db)
 from .db import *
 
 api = Api(app)
+uploads = JobQueue(app.config['UPLOAD_WORKERS'], app.config['UPLOAD_QUEUE_SIZE'], app.config['UPLOAD_JOB_TTL'],
+                   app.config['UPLOAD_JOBS_DIR'])
 api.add_resource(UploadResource, '/api/upload')
+api.add_resource(UploadJobResource, '/api/upload/<job_id>')
 api.add_resource(DocResource, '/api/doc/<int:doc_id>')
 
-corpus, data_samples, dictionary, metadata = load_uci(app.config['DOCS_LOCATION'])
-tfidf = TfidfModel(dictionary=dictionary, smartirs='ntc')
-del corpus
+# with SHM_DIR set, read-only arrays are mapped from the copies the loader (recommenders.shm) put there
+Tokenizer.load_stems(shm.attach(app.config['STEMS_PATH']))
+data_samples, dictionary, metadata = load_serving(app.config['DOCS_LOCATION'], shm.attach)
+tfidf = Tfidf(dictionary)
+
+
+def serving(model):
+    """Applies the serving-time index settings to a loaded model"""
+    if app.config['ANN_PROBE_OVERRIDE'] and isinstance(model.index, IvfIndex):
+        model.index.n_probe = app.config['ANN_PROBE']
+    return model
+
+
+def load_d2v():
+    Doc2vecModel.INFER_WORKERS = app.config['D2V_INFER_WORKERS']
+    model = Doc2vecModel.load(shm.attach(app.config['D2V_PATH']))
+    model.cache_vectors(app.config['D2V_VECTOR_CACHE_BYTES'])
+    return serving(model)
+
+
+MODELS = ['lsi', 'lda', 'artm', 'd2v']
+# a pool per model, so that queries a slow model still runs past their deadline don't hold up the others
+executors = {name: ThreadPoolExecutor(app.config['MODEL_WORKERS'], thread_name_prefix=name) for name in MODELS}
+inflight = {name: threading.BoundedSemaphore(app.config['MODEL_MAX_INFLIGHT']) for name in MODELS}
+models = ModelRegistry()
+models.register('lsi', lambda: serving(LsiModel.load(shm.attach(app.config['LSI_PATH']))))
+models.register('lda', lambda: serving(LdaModel.load(shm.attach(app.config['LDA_PATH']))))
+models.register('artm', lambda: serving(BigArtmModel.load(shm.attach(app.config['ARTM_PATH']), dictionary=dictionary)))
+models.register('d2v', load_d2v)
+if app.config['MODEL_PREWARM']:
+    models.prewarm()
+
+
+def manifest_stamp(path):
+    """mtime of a saved model's manifest, 'missing' for a model that isn't built, which then fails to load"""
+    try:
+        return str(os.stat(os.path.join(path, storage.MANIFEST)).st_mtime_ns)
+    except OSError:
+        return 'missing'
+
 
-logging.info('Unpickling models')
-lsi = LsiModel.load(app.config['LSI_PICKLE'])
-lda = LdaModel.load(app.config['LDA_PICKLE'])
-artm = BigArtmModel.load(app.config['ARTM_PICKLE'])
-d2v = Doc2vecModel.load(app.config['D2V_PICKLE'])
-logging.info('Unpickling finished')
+def model_version():
+    """Changes whenever the corpus grows or a model is saved again"""
+    paths = [app.config[k] for k in ['LSI_PATH', 'LDA_PATH', 'ARTM_PATH', 'D2V_PATH']]
+    return '%d:%s' % (len(data_samples), ':'.join(manifest_stamp(path) for path in paths))
+
+
+results = ResultCache(app.config['RESULT_CACHE_BYTES'], model_version())
+if app.config['RESULT_CACHE_PATH']:
+    results.load(app.config['RESULT_CACHE_PATH'])
+    atexit.register(results.save, app.config['RESULT_CACHE_PATH'])
+
+VARIANTS = {'lsi', 'lda', 'd2v', 'artm', 'artm_tfidf'}
+neighbours = None
+if os.path.exists(os.path.join(app.config['NEIGHBOURS_PATH'], 'manifest.json')):
+    neighbours = NeighbourTable.load(shm.attach(app.config['NEIGHBOURS_PATH']))
+    if len(neighbours) != len(data_samples) or not VARIANTS <= neighbours.variants:
+        logging.warning('Neighbour table does not match the corpus, recommendations will be computed live')
+        neighbours = None
+
+
+REQUEST_SECONDS = Histogram('recommender_request_seconds', 'Time to serve a request', ['endpoint', 'status'])
+DEADLINE_MISSES = Counter('recommender_deadline_misses', 'Model queries which missed their deadline', ['variant'])
+OVERLOAD_SKIPS = Counter('recommender_overload_skips', 'Model queries skipped for too many queries in flight',
+                         ['variant'])
+Callback('recommender_result_cache_hits', 'Result cache hits', lambda: results.hits, 'counter')
+Callback('recommender_result_cache_misses', 'Result cache misses', lambda: results.misses, 'counter')
+Callback('recommender_result_cache_bytes', 'Size of the result cache', lambda: results.size)
+Callback('recommender_vector_cache_hits', 'Doc2vec inferred vector cache hits',
+         lambda: vector_cache_stats().get('hits'), 'counter')
+Callback('recommender_vector_cache_misses', 'Doc2vec inferred vector cache misses',
+         lambda: vector_cache_stats().get('misses'), 'counter')
+Callback('recommender_pending_uploads', 'Uploads queued or being processed', lambda: uploads.pending())
+Callback('recommender_model_ready', 'Whether a model is loaded', lambda: {
+    name: int(models.ready(name)) for name in MODELS}, labels=['model'])
+
+
+def vector_cache_stats():
+    d2v = models.get('d2v', wait=False)
+    return d2v.vector_cache.stats() if d2v is not None and d2v.vector_cache is not None else {}
+
+
+@app.before_request
+def start_timer():
+    g.t0 = time()
+
+
+@app.after_request
+def observe_request(response):
+    if 't0' in g:
+        REQUEST_SECONDS.observe(time() - g.t0, endpoint=request.endpoint or 'unknown', status=response.status_code)
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    Stage latencies by model, request latencies, cache and document store counters in the Prometheus format.
+    Only this worker's values, labelled with its pid: a scrape reaches one worker, sum over pid for the totals
+    """
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@app.route('/healthz')
+def healthz():
+    """Per-model readiness, load time and resident size; pages are served with whatever models are ready"""
+    return jsonify(dict(models.health(), documents=len(data_samples)))
 
 
 @app.route('/')
@@ -97,21 +311,29 @@ def index():
 
 @app.route('/doc/<int:idx>')
 def doc(idx):
-    similar = get_similar(data_samples[idx], lambda sim: (sim, data_samples[sim], metadata[sim]), True)
+    similar = get_similar_for_doc(idx, lambda sim: (sim, data_samples[sim], metadata[sim]))
     return render_template('doc.html', doc=data_samples[idx], idx=idx, case_num=metadata[idx]['case_num'], **similar)
 
 
 @app.route('/upload', methods=['POST'])
 def similar_for_file():
-    file = request.files['file']
-
-    tmp_file = tempfile.NamedTemporaryFile()
-    file.save(tmp_file)
-    text = preprocess(unpack.from_file(tmp_file.name)['content'])
-    tmp_file.close()
-
-    similar = get_similar(text, lambda sim: (sim, data_samples[sim], metadata[sim]))
-    return render_template('doc.html', doc=text, idx=-1, **similar)
+    try:
+        job_id = submit_upload(request.files['file'])
+    except QueueFull:
+        return render_template('upload.html', status='busy'), 503, {'Retry-After': '10'}
+    return redirect(url_for('upload_result', job_id=job_id))
+
+
+@app.route('/upload/<job_id>')
+def upload_result(job_id):
+    job = uploads.get(job_id)
+    if job is None:
+        return render_template('upload.html', status='unknown'), 404
+    if job['status'] != 'done':
+        return render_template('upload.html', status=job['status'], error=job.get('error'))
+
+    similar = map_similar(job['result']['similar'], lambda sim: (sim, data_samples[sim], metadata[sim]))
+    return render_template('doc.html', doc=job['result']['text'], idx=-1, **similar)
 
 
 @app.route('/rate/<int:doc_id>/<int:rec_id>', methods=['POST'])
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 root_dir = os.path.dirname(os.path.abspath(__file__)) + "/.."
 
@@ -11,6 +12,81 @@ LDA_PICKLE = os.environ.get('LDA_PICKLE', UCI_FOLDER + '/lda.pickle')
 D2V_PICKLE = os.environ.get('D2V_PICKLE', UCI_FOLDER + '/d2v.pickle')
 ARTM_PICKLE = os.environ.get('ARTM_PICKLE', UCI_FOLDER + '/artm_new.pkl')
 
+# Model directories in the mmap-able format, see recommenders.storage
+LSI_PATH = os.environ.get('LSI_PATH', UCI_FOLDER + '/lsi')
+LDA_PATH = os.environ.get('LDA_PATH', UCI_FOLDER + '/lda')
+D2V_PATH = os.environ.get('D2V_PATH', UCI_FOLDER + '/d2v')
+ARTM_PATH = os.environ.get('ARTM_PATH', UCI_FOLDER + '/artm')
+
+# Packed document texts (recommenders.docstore): documents per zlib block, 0 stores them uncompressed
+DOCS_BLOCK_SIZE = int(os.environ.get('DOCS_BLOCK_SIZE', 0))
+
+# Surface form -> stem/token id table, see recommenders.stems
+STEMS_PATH = os.environ.get('STEMS_PATH', UCI_FOLDER + '/stems')
+
+# Precomputed recommendations for corpus documents, see recommenders.neighbours
+NEIGHBOURS_PATH = os.environ.get('NEIGHBOURS_PATH', UCI_FOLDER + '/neighbours')
+N_NEIGHBOURS = int(os.environ.get('N_NEIGHBOURS', 20))
+
+# tmpfs directory (e.g. /dev/shm/recommenders) the loader, python -m recommenders.shm, copies the models and
+# corpus arrays to, so that all web workers map one shared copy; empty maps them from their own locations
+SHM_DIR = os.environ.get('SHM_DIR', '')
+
+# Rows per on-disk index shard for LSI/LDA; 0 keeps the whole index in memory
+INDEX_SHARD_SIZE = int(os.environ.get('INDEX_SHARD_SIZE', 0))
+
+# Approximate index (train_models.py --ann): number of k-means lists and lists probed per query.
+# Set at serving time, ANN_PROBE overrides the value the webapp's indexes were built with
+ANN_LISTS = int(os.environ.get('ANN_LISTS', 1024))
+ANN_PROBE = int(os.environ.get('ANN_PROBE', 16))
+ANN_PROBE_OVERRIDE = 'ANN_PROBE' in os.environ
+
+# Quantized index (train_models.py --quantize): code type, float16 or int8, and candidates per result
+# rescored exactly against the float32 rows (0 to return the approximate similarities)
+INDEX_QUANTIZATION = os.environ.get('INDEX_QUANTIZATION', 'int8')
+QUANT_RERANK = int(os.environ.get('QUANT_RERANK', 4))
+
+# recommenders.ingest rebuilds the corpus and retrains the models once the documents added incrementally
+# exceed this fraction of the documents the models were trained on
+RETRAIN_THRESHOLD = float(os.environ.get('RETRAIN_THRESHOLD', 0.2))
+
+# Load the models on a background thread at startup; pages are served with the ones which are ready.
+# With 0 every model is loaded by the first request that needs it
+MODEL_PREWARM = int(os.environ.get('MODEL_PREWARM', 1))
+
+# Threads of each model's own query pool, and how many queries of a model may wait or run at once:
+# a model that is slower than its deadline keeps running queries after they are answered as missing,
+# beyond the limit it's skipped instead of piling them up
+MODEL_WORKERS = int(os.environ.get('MODEL_WORKERS', 4))
+MODEL_MAX_INFLIGHT = int(os.environ.get('MODEL_MAX_INFLIGHT', 2 * MODEL_WORKERS))
+# Per-model deadlines (seconds) in webapp.get_similar
+MODEL_DEADLINE = float(os.environ.get('MODEL_DEADLINE', 5))
+MODEL_DEADLINES = {
+    variant: float(os.environ.get('MODEL_DEADLINE_' + variant.upper(), MODEL_DEADLINE))
+    for variant in ['lsi', 'lda', 'd2v', 'artm', 'artm_tfidf']
+}
+
+# Threads for Doc2vec inference of a batch of documents, and the budget (bytes) of its inferred vector cache
+D2V_INFER_WORKERS = int(os.environ.get('D2V_INFER_WORKERS', os.cpu_count()))
+D2V_VECTOR_CACHE_BYTES = int(os.environ.get('D2V_VECTOR_CACHE_BYTES', 0))
+
+# Cache of get_similar results keyed by text and model version: memory budget in bytes,
+# and a file to keep it in between restarts (none if empty)
+RESULT_CACHE_BYTES = int(os.environ.get('RESULT_CACHE_BYTES', 64 * 2 ** 20))
+RESULT_CACHE_PATH = os.environ.get('RESULT_CACHE_PATH', '')
+
+# Uploads are processed in the background: worker threads, max queued or running uploads
+# and how long (seconds) finished results are kept for /api/upload/<job_id>
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 2))
+UPLOAD_QUEUE_SIZE = int(os.environ.get('UPLOAD_QUEUE_SIZE', 32))
+UPLOAD_JOB_TTL = int(os.environ.get('UPLOAD_JOB_TTL', 3600))
+# Folder the state and results of upload jobs are kept in, shared by all web workers so that any of them
+# can answer for a job another one runs. Workers on different hosts need a shared filesystem here
+UPLOAD_JOBS_DIR = os.environ.get('UPLOAD_JOBS_DIR', os.path.join(tempfile.gettempdir(), 'recommender-uploads'))
+
+# Processes for the topic count sweep in evaluation.py
+SWEEP_PROCESSES = int(os.environ.get('SWEEP_PROCESSES', os.cpu_count()))
+
 RESTFUL_JSON = {
     'ensure_ascii': False,
     'indent': 4
@@ -0,0 +1,37 @@
+from recommenders.cache import ResultCache
+
+
+def test_doc_id_is_part_of_the_key():
+    cache = ResultCache(2 ** 20, 'v1')
+    cache.put('text', 'by text')
+    cache.put('text', 'by document', doc_id=5)
+    assert cache.get('text') == 'by text'
+    assert cache.get('text', 5) == 'by document'
+    assert cache.get('text', 6) is None
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / 'results.pickle')
+    cache = ResultCache(2 ** 20, 'v1')
+    cache.put('text', [1, 2])
+    cache.save(path)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['results.pickle']
+
+    restored = ResultCache(2 ** 20, 'v1')
+    restored.load(path)
+    assert restored.get('text') == [1, 2]
+    other = ResultCache(2 ** 20, 'v2')
+    other.load(path)
+    assert other.get('text') is None
+
+
+def test_load_broken_file(tmp_path):
+    path = tmp_path / 'results.pickle'
+    cache = ResultCache(2 ** 20, 'v1')
+    cache.put('text', [1, 2])
+    cache.save(str(path))
+    path.write_bytes(path.read_bytes()[:20])
+
+    restored = ResultCache(2 ** 20, 'v1')
+    restored.load(str(path))
+    assert restored.get('text') is None
@@ -0,0 +1,33 @@
+import numpy as np
+
+from recommenders.jobs import JobQueue
+
+
+def wait(queue, job_id):
+    queue.executor.shutdown(wait=True)
+    return queue.get(job_id)
+
+
+def test_other_process_reads_job(tmp_path):
+    runner, reader = JobQueue(folder=str(tmp_path)), JobQueue(folder=str(tmp_path))
+    job_id = runner.submit(lambda: {'similar': {'lsi': [np.int64(3), 1]}})
+    assert reader.get(job_id)['status'] in ('queued', 'running', 'done')
+    wait(runner, job_id)
+    job = reader.get(job_id)
+    assert job['status'] == 'done'
+    assert job['result'] == {'similar': {'lsi': [3, 1]}}
+
+
+def test_failed_job(tmp_path):
+    runner, reader = JobQueue(folder=str(tmp_path)), JobQueue(folder=str(tmp_path))
+    job_id = runner.submit(lambda: 1 / 0)
+    wait(runner, job_id)
+    assert reader.get(job_id)['status'] == 'failed'
+
+
+def test_unknown_and_expired(tmp_path):
+    queue = JobQueue(ttl=-1, folder=str(tmp_path))
+    assert queue.get('../../etc/passwd') is None
+    assert queue.get('0' * 32) is None
+    job_id = queue.submit(lambda: 1)
+    assert wait(queue, job_id) is None
@@ -0,0 +1,31 @@
+import numpy as np
+
+from recommenders.index import DenseIndex, unit_rows
+from recommenders.models import ModelBase
+from recommenders.neighbours import NeighbourTable
+
+
+class VectorModel(ModelBase):
+    """Documents are their own vectors; the stored ones differ from projecting the documents again"""
+    def __init__(self, stored):
+        self.index = DenseIndex(unit_rows(stored))
+
+    def project(self, docs):
+        return -np.asarray(docs)
+
+
+def test_short_rows_are_padded():
+    vectors = np.random.RandomState(0).rand(3, 4).astype(np.float32)
+    table = NeighbourTable.compute({'m': (VectorModel(vectors), list(vectors))}, 3, topn=5)
+    assert (table.ids['m'][:, 3:] == -1).all()
+    for doc_id in range(3):
+        assert sorted(table.get('m', doc_id)) == [0, 1, 2]
+        assert len(table.get('m', doc_id, 1, 5)) == 2
+
+
+def test_stored_vectors():
+    vectors = np.random.RandomState(1).rand(10, 4).astype(np.float32)
+    model = VectorModel(vectors)
+    table = NeighbourTable.compute({'m': (model, None)}, 10, topn=5)
+    for doc_id in range(10):
+        assert table.get('m', doc_id) == model.get_similar_by_id(doc_id, 5)
@@ -0,0 +1,47 @@
+import random
+
+import pytest
+
+from recommenders.synthetic import generate
+from text_processing.base import preprocess, preprocess_reference
+
+# pieces of text every rule of preprocess matches, in different cases and forms
+FRAGMENTS = [
+    'Арбитражного процессуального кодекса', 'арбитражно-процессуальный кодекс', 'Гражданского кодекса',
+    'налоговый кодекс', 'Кодекса административного судопроизводства', 'кодекса об административных правонарушениях',
+    'Кодекс административных правонарушений', 'общество с ограниченной ответственностью',
+    'Обществом с ограниченной ответственностью', 'открытое акционерное общество', 'закрытого акционерного общества',
+    'публичное акционерное общество', 'акционерное общество', 'Федеральное казенное учреждение',
+    '1 234 567 руб. 89 коп.', '100 рублей', '5 000,00 руб.', '12.03.2017 г.', '1.2.2015', '5 мая 2016 года',
+    '12345678', '2017', '1551', 'ООО «Ромашка»', 'ЗАО "Вектор" ', 'АО «Гр»', '"', '«', '»', 'руб', 'коп',
+    'установил:\n', 'решил:\n', 'Р Е Ш Е Н И Е ', 'суд', 'истец', 'в размере', ',', '(', ')', '0', '7',
+]
+SEPARATORS = ['', '', ' ', '  ', '\n', '\n\n', ' \n', '-']
+
+
+def glued(rng, n):
+    return ''.join(rng.choice(FRAGMENTS) + rng.choice(SEPARATORS) for _ in range(n))
+
+
+@pytest.mark.parametrize('text', [
+    'публичное акционерное обществооткрытое акционерное общество',
+    'кодекса об административных правонарушенияхАрбитражного процессуального кодекса',
+    'обществ12345 с ограниченной ответственностью',
+    '100\n200 руб.',
+    'установил:\nГражданского кодекса\nрешил:\nвзыскать',
+    '',
+])
+def test_glued_examples(text):
+    assert preprocess(text) == preprocess_reference(text)
+
+
+def test_fuzz():
+    rng = random.Random(0)
+    for _ in range(3000):
+        text = glued(rng, rng.randint(1, 12))
+        assert preprocess(text) == preprocess_reference(text), repr(text)
+
+
+def test_judgments():
+    for _, _, text in generate(50, seed=1):
+        assert preprocess(text) == preprocess_reference(text)
@@ -0,0 +1,24 @@
+from gensim.corpora import Dictionary
+
+from recommenders.stems import StemTable
+
+
+def stem(word):
+    return word[:4]
+
+
+DICTIONARY = Dictionary([['дого', 'пост', 'суд']])
+
+
+def test_doc2bow_matches_stemming():
+    table = StemTable.build(['договора', 'поставки'], stem, DICTIONARY)
+    words = ['договора', 'договору', 'поставки', 'суд', 'иск']
+    assert table.doc2bow(words, stem, DICTIONARY) == DICTIONARY.doc2bow([stem(w) for w in words])
+
+
+def test_doc2bow_empty():
+    empty = StemTable.build([], stem, DICTIONARY)
+    words = ['договора', 'суд', 'иск']
+    assert empty.doc2bow(words, stem, DICTIONARY) == DICTIONARY.doc2bow([stem(w) for w in words])
+    assert empty.doc2bow([], stem, DICTIONARY) == []
+    assert StemTable.build(['суд'], stem, DICTIONARY).doc2bow([], stem, DICTIONARY) == []
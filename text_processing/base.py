@@ -1,4 +1,6 @@
 import re
+from collections import namedtuple
+from functools import partial
 
 from natasha import MoneyExtractor, OrganisationExtractor, DatesExtractor
 from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
@@ -38,9 +40,11 @@ def fix_cap_spaces(text: str):
     return CAP_SPACES.sub(lambda m: ' '+m.group(1).replace(' ', '')+' ', text)
 
 
+NEWLINES = re.compile(r'([а-яА-Я,"«»()0-9])\s*\n+', re.MULTILINE)
+
+
 def remove_newlines(text: str):
-    regex = re.compile(r'([а-яА-Я,"«»()0-9])\s*\n+', re.MULTILINE)
-    return regex.sub(r'\1 ', text)
+    return NEWLINES.sub(r'\1 ', text)
 
 
 def remove_numbers(text: str):
@@ -60,7 +64,7 @@ def remove_numbers(text: str):
 
 def parse_orgs_simple(text: str):
     for regex, repl in abbrs:
-        text = regex.sub(repl, text)  # TODO optimize
+        text = regex.sub(repl, text)
 
     text = re.sub(r"[А-Я]+\s+«[^»]{3,}»", 'ORG', text)
     text = re.sub(r"[А-Я]+\s+\".*?\"(?=[^\w])", 'ORG', text)
@@ -78,19 +82,24 @@ def enum_orgs(text: str):
     return text
 
 
+CUT_START = re.compile(r'установил\s*:\s*\n', re.IGNORECASE)
+CUT_END = re.compile(r'решил\s*:\s*\n', re.IGNORECASE)
+
+
 def cut_parts(text: str) -> str:
     text = re.sub(r'^.*установил\s*:\s*\n', '', text, 1, re.IGNORECASE | re.DOTALL)
     text = re.sub(r'\s*решил\s*:\s*\n.*$', '', text, 1, re.IGNORECASE | re.DOTALL)
     return text
 
 
-def preprocess(text: str) -> str:
+def preprocess_reference(text: str) -> str:
+    """Straightforward version of preprocess, kept to check it against (tests, check_preprocess)"""
     text = text.strip()
     text = fix_cap_spaces(text)
     text = cut_parts(text)
 
     for regex, repl in codex_regexes.items():
-        text = regex.sub(repl, text)  # TODO optimize
+        text = regex.sub(repl, text)
 
     text = remove_newlines(text)
     text = remove_numbers(text)
@@ -99,6 +108,79 @@ def preprocess(text: str) -> str:
     return text
 
 
+class Rule(namedtuple('Rule', 'pattern repl anchor ignore_case')):
+    """A substitution of preprocess. Every match contains `anchor` (lowercased if `ignore_case`)"""
+    def applies(self, text: str, lowered: str):
+        return self.anchor is None or self.anchor in (lowered if self.ignore_case else text)
+
+    def compile(self):
+        return partial(re.compile('(?i:%s)' % self.pattern if self.ignore_case else self.pattern).sub, self.repl)
+
+
+def rule(pattern, repl, anchor=None, ignore_case=False):
+    return Rule(pattern, repl, anchor, ignore_case)
+
+
+# Rules of preprocess_reference, in its order. They can't be merged into alternations: leftmost-first matching
+# differs from applying them one after another when matches overlap, which happens with words glued together
+codex_anchors = ['процессуальн', 'гражданск', 'налогов', 'судопроизводств', 'правонарушени']
+abbr_anchors = ['ограниченной', 'открыт', 'закрыт', 'публичн', 'акционерн', 'казенн']
+
+RULES = [
+    rule(regex.pattern, repl, anchor, True) for (regex, repl), anchor in zip(codex_regexes.items(), codex_anchors)
+] + [
+    rule(r'([а-яА-Я,"«»()0-9])\s*\n+', r'\1 ', '\n'),
+    rule(r'\d[\d\s]+([,.]\d\d\s*)?руб(\.|л[а-я]+)(\s*\d\d\s*коп(\.|[а-я]+))?', 'SUM', 'руб'),
+    rule(r'\d\d?\.\d\d?\.\d{4}(\s*г(\.|ода))?', 'DATE'),
+    rule(r'\d\d? [а-я]+ \d{4} г(\.|ода)', 'DATE'),
+    rule(r'(\d{5,})', 'NUM'),
+    rule(r'[2-9]\d{3,}', 'NUM'),
+] + [
+    rule(regex.pattern, repl, anchor, True) for (regex, repl), anchor in zip(abbrs, abbr_anchors)
+] + [
+    rule(r"[А-Я]+\s+«[^»]{3,}»", 'ORG', '«'),
+    rule(r"[А-Я]+\s+\".*?\"(?=[^\w])", 'ORG', '"'),
+]
+SUBSTITUTIONS = [(r, r.compile()) for r in RULES]
+
+
+def cut_parts_fast(text: str, lowered: str) -> str:
+    """Same as cut_parts, but looks for the keywords with str.find instead of a backtracking regex"""
+    if len(lowered) != len(text):  # lowercasing has changed offsets
+        return cut_parts(text)
+
+    pos = len(lowered)
+    while True:
+        pos = lowered.rfind('установил', 0, pos)
+        if pos < 0:
+            break
+        start = CUT_START.match(text, pos)
+        if start:
+            text, lowered = text[start.end():], lowered[start.end():]
+            break
+
+    pos = -1
+    while True:
+        pos = lowered.find('решил', pos + 1)
+        if pos < 0:
+            return text
+        if CUT_END.match(text, pos):
+            while pos and text[pos - 1].isspace():
+                pos -= 1
+            return text[:pos]
+
+
+def preprocess(text: str) -> str:
+    text = text.strip()
+    text = fix_cap_spaces(text)
+    lowered = text.lower()
+    text = cut_parts_fast(text, lowered)
+    for r, substitute in SUBSTITUTIONS:
+        if r.applies(text, lowered):
+            text = substitute(text)
+    return text
+
+
 pipeline = Pipeline([
     ('count', CountVectorizer()),
     ('tfidf', TfidfTransformer())
@@ -0,0 +1,85 @@
+"""
+Checks that preprocess gives exactly the same output as preprocess_reference on a set of judgments
+and measures the throughput of both.
+
+    python -m text_processing.check_preprocess <html dir> [golden.jsonl] [--limit N]
+
+With a golden file, outputs are compared to it instead (it's written from preprocess_reference if missing)
+"""
+import argparse
+import difflib
+import json
+import os
+from pathlib import Path
+from time import time
+
+import bs4
+
+from text_processing.base import preprocess, preprocess_reference
+
+
+def load_texts(basedir, limit=None):
+    """Raw judgment texts, extracted the same way simple.parse does"""
+    texts = []
+    for f in sorted(Path(basedir).rglob("*.html")):
+        with open(f, 'r') as fd:
+            texts.append((str(f), bs4.BeautifulSoup('\n'.join(fd), "lxml").text))
+        if limit and len(texts) >= limit:
+            break
+    return texts
+
+
+def benchmark(fn, texts):
+    t0 = time()
+    out = [fn(text) for _, text in texts]
+    elapsed = max(time() - t0, 1e-9)
+    mb = sum(len(text.encode('utf-8')) for _, text in texts) / 2 ** 20
+    print("%s: %d docs in %.3fs, %.1f docs/sec, %.2f MB/s" % (
+        fn.__name__, len(texts), elapsed, len(texts) / elapsed, mb / elapsed))
+    return out
+
+
+def show_diff(path, expected, actual, context=80):
+    i = next((i for i, (a, b) in enumerate(zip(expected, actual)) if a != b), min(len(expected), len(actual)))
+    print("MISMATCH %s at char %d" % (path, i))
+    lo = max(i - context, 0)
+    for line in difflib.unified_diff([expected[lo:i + context]], [actual[lo:i + context]], 'expected', 'actual',
+                                     lineterm=''):
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('basedir')
+    parser.add_argument('golden', nargs='?')
+    parser.add_argument('--limit', type=int)
+    args = parser.parse_args()
+
+    texts = load_texts(args.basedir, args.limit)
+    actual = benchmark(preprocess, texts)
+
+    if args.golden and os.path.exists(args.golden):
+        with open(args.golden, 'r') as fd:
+            golden = dict((e['path'], e['text']) for e in map(json.loads, fd))
+        expected = [golden.get(path) for path, _ in texts]
+    else:
+        expected = benchmark(preprocess_reference, texts)
+        if args.golden:
+            with open(args.golden, 'w') as fd:
+                for (path, _), text in zip(texts, expected):
+                    fd.write(json.dumps({'path': path, 'text': text}, ensure_ascii=False) + '\n')
+            print("golden outputs written to %s" % args.golden)
+
+    mismatches = 0
+    for (path, _), e, a in zip(texts, expected, actual):
+        if e is None:
+            continue
+        if e != a:
+            mismatches += 1
+            show_diff(path, e, a)
+    print("%d of %d docs differ" % (mismatches, len(texts)))
+    return mismatches
+
+
+if __name__ == '__main__':
+    exit(1 if main() else 0)
@@ -1,6 +1,11 @@
+import hashlib
+import json
 import os
 import re
+from collections import Counter
+from multiprocessing import Pool
 from pathlib import Path
+from time import time
 
 import bs4
 from joblib import Memory
@@ -41,11 +46,80 @@ def parse_all(basedir, mem: Memory = None, with_paths=False, from_cache=False):
             yield (f, text) if with_paths else text
 
 
+def file_hash(path):
+    with open(path, 'rb') as fd:
+        return hashlib.sha1(fd.read()).hexdigest()
+
+
+def load_manifest(manifest_path):
+    """Latest manifest entry for every path"""
+    entries = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as fd:
+            for line in fd:
+                entry = json.loads(line)
+                entries[entry['path']] = entry
+    return entries
+
+
+def is_done(entry):
+    """Whether a manifest entry needs no reprocessing, if its file is unchanged: not failed, and the cache is there"""
+    return entry['status'] == 'skipped' or (entry['status'] == 'ok' and os.path.exists(cache_path(entry['path'])))
+
+
+def process(task):
+    path, mtime, old_entry = task
+    try:
+        content_hash = file_hash(path)
+        if old_entry is not None and old_entry['hash'] == content_hash and is_done(old_entry):
+            return dict(old_entry, mtime=mtime)  # touched, but not changed
+
+        text = parse(path)
+        if text is None:
+            status = 'skipped'
+        else:
+            os.makedirs(os.path.dirname(cache_path(path)), exist_ok=True)
+            with open(cache_path(path), 'w') as out:
+                out.write(text)
+            status = 'ok'
+        return {'path': path, 'mtime': mtime, 'hash': content_hash, 'status': status}
+    except Exception as e:
+        return {'path': path, 'mtime': mtime, 'hash': None, 'status': 'error', 'error': str(e)}
+
+
+def process_all(basedir, manifest_path, processes=None, chunksize=16):
+    """
+    Preprocesses every html file under basedir into its cache_path on a process pool.
+    Results go to an append-only manifest (path, mtime, content hash, status),
+    so a re-run only processes new, changed or failed files and those whose cache file has gone
+    """
+    manifest = load_manifest(manifest_path)
+    tasks = []
+    n_files = 0
+    for f in Path(basedir).rglob("*.html"):
+        n_files += 1
+        mtime = os.stat(f).st_mtime
+        entry = manifest.get(str(f))
+        if entry is None or entry['mtime'] != mtime or not is_done(entry):
+            tasks.append((str(f), mtime, entry))
+    print("%d of %d files to process" % (len(tasks), n_files))
+
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    t0 = time()
+    statuses = Counter()
+    with Pool(processes) as pool, open(manifest_path, 'a') as out:
+        for i, entry in enumerate(pool.imap_unordered(process, tasks, chunksize), 1):
+            out.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            statuses[entry['status']] += 1
+            if i % 1000 == 0:
+                out.flush()
+                print("%d/%d docs, %.1f docs/sec" % (i, len(tasks), i / (time() - t0)))
+
+    elapsed = time() - t0
+    print("processed %d docs in %.3fs (%.1f docs/sec): %s" % (
+        len(tasks), elapsed, len(tasks) / max(elapsed, 1e-9), dict(statuses)))
+    return statuses
+
+
 if __name__ == '__main__':
-    for path, doc in parse_all("../out/docs_simple2", with_paths=True):
-        path = cache_path(path)
-        if os.path.exists(path):
-            continue
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'w') as out:
-            out.write(doc)
+    process_all("../out/docs_simple2", "../out/docs_simple2_processed/manifest.jsonl")